@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the edX endpoints used by edxdlr
+
+It serves synthetic courses of configurable size: the login and token apis,
+the course list, outlines, sequences, xblock pages with videos and assets,
+mp4 files (with byte ranges), HLS playlists and segments, and transcripts.
+Every request can be delayed to imitate a remote server.
+
+Run it on its own with `python bench/fake_edx.py --port 8000`, or start it
+from run_bench.py.
+"""
+
+import argparse
+import html
+import json
+import re
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+
+
+class CourseShape(object):
+    """
+    Size of the synthetic courses served
+    """
+    def __init__(self, courses=1, chapters=4, sequentials=4, verticals=4,
+                 videos=1, assets=1, mp4_size=2 * 1024 * 1024,
+                 segments=10, segment_size=128 * 1024, asset_size=64 * 1024,
+                 cues=500, languages=('en', 'zh')):
+        self.courses = courses
+        self.chapters = chapters
+        self.sequentials = sequentials
+        self.verticals = verticals
+        self.videos = videos
+        self.assets = assets
+        self.mp4_size = mp4_size
+        self.segments = segments
+        self.segment_size = segment_size
+        self.asset_size = asset_size
+        self.cues = cues
+        self.languages = list(languages)
+
+    def course_id(self, c):
+        return 'course-v1:BenchX+C%d+2024' % c
+
+    def block_id(self, c, kind, name):
+        return 'block-v1:BenchX+C%d+2024+type@%s+block@%s' % (c, kind, name)
+
+
+def _payload(name, size):
+    """
+    Deterministic bytes of the given size for a file name
+    """
+    seed = (name.encode('utf-8') + b'\x00') * 64
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class FakeEdx(object):
+    """
+    The synthetic site: builds every response from the course shape
+    """
+    def __init__(self, shape, latency=0.0):
+        self.shape = shape
+        self.latency = latency
+        self.base_url = None
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes_sent = 0
+
+    def count(self, endpoint, size):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_sent += size
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'bytes_sent': self.bytes_sent}
+
+    # ##### json apis
+
+    def course_list(self):
+        shape = self.shape
+        courses = []
+        for c in range(shape.courses):
+            course_id = shape.course_id(c)
+            courses.append({
+                'courseRun': {'courseId': course_id,
+                              'homeUrl': self.base_url + '/course/' + course_id + '/home',
+                              'isStarted': True},
+                'course': {'courseName': 'Bench course %d' % c},
+                'enrollment': {'isAudit': False, 'isAuditAccessExpired': False,
+                               'isVerified': True},
+            })
+        return {'courses': courses}
+
+    def outline(self, course_id):
+        shape = self.shape
+        c = int(re.search(r'\+C(\d+)\+', course_id).group(1))
+        blocks = {}
+        course_block = shape.block_id(c, 'course', 'course')
+        # the course block is the root, see EdxExtractor.sort_blocks
+        blocks[course_block] = {'id': course_block, 'type': 'course',
+                                'display_name': 'Bench course %d' % c,
+                                'lms_web_url': '', 'children': []}
+        for ch in range(shape.chapters):
+            chapter = shape.block_id(c, 'chapter', 'ch%d' % ch)
+            blocks[course_block]['children'].append(chapter)
+            blocks[chapter] = {'id': chapter, 'type': 'chapter',
+                               'display_name': 'Chapter %d' % ch,
+                               'lms_web_url': '', 'children': []}
+            for s in range(shape.sequentials):
+                sequential = shape.block_id(c, 'sequential', 'ch%ds%d' % (ch, s))
+                blocks[chapter]['children'].append(sequential)
+                blocks[sequential] = {'id': sequential, 'type': 'sequential',
+                                      'display_name': 'Sequence %d' % s,
+                                      'lms_web_url': ''}
+        return {'course_blocks': {'blocks': blocks}}
+
+    def sequence(self, sequential):
+        name = sequential.rsplit('block@', 1)[1]
+        prefix = sequential.split('+type@')[0]
+        items = [{'id': '%s+type@vertical+block@%sv%d' % (prefix, name, v),
+                  'page_title': 'Unit %d' % v,
+                  'type': 'video',
+                  'complete': False}
+                 for v in range(self.shape.verticals)]
+        return {'item_id': sequential, 'items': items}
+
+    # ##### pages and media
+
+    def xblock(self, vertical):
+        shape = self.shape
+        name = vertical.rsplit('block@', 1)[1]
+        parts = ['<html><body><h2>%s</h2>' % name, '<p>%s</p>' % ('lorem ipsum ' * 200)]
+        for i in range(shape.videos):
+            video = '%sx%d' % (name, i)
+            metadata = {
+                'lmsRootURL': self.base_url,
+                'sources': [self.base_url + '/media/%s.mp4' % video,
+                            self.base_url + '/hls/%s/master.m3u8' % video],
+                'transcriptAvailableTranslationsUrl': self.base_url + '/transcript/%s/available' % video,
+                'transcriptTranslationUrl': self.base_url + '/transcript/%s/%%s' % video,
+                'transcriptLanguage': 'en',
+            }
+            escaped = html.escape(html.escape(json.dumps(metadata)))
+            video_id = '%08x' % zlib.crc32(video.encode('utf-8'))
+            parts.append('<div id="video_%s" class="video closed" '
+                         "data-metadata='%s'><div>player</div></div>" % (video_id, escaped))
+        for i in range(shape.assets):
+            parts.append('<a href="/assets/%s-%d.pdf" target="[object Object]">'
+                         'handout %d</a>' % (name, i, i))
+        parts.append('</body></html>')
+        return ''.join(parts)
+
+    def transcript(self, video, lang):
+        cues = self.shape.cues
+        return {'start': [i * 2500 for i in range(cues)],
+                'end': [i * 2500 + 2000 for i in range(cues)],
+                'text': ['%s line %d' % (lang, i) for i in range(cues)]}
+
+    def master_playlist(self, video):
+        return ('#EXTM3U\n'
+                '#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=300000,RESOLUTION=640x360\n'
+                'low.m3u8\n'
+                '#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=900000,RESOLUTION=1280x720\n'
+                'index.m3u8\n')
+
+    def media_playlist(self, video):
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:4']
+        for i in range(self.shape.segments):
+            lines.append('#EXTINF:4.0,')
+            lines.append('seg%d.ts' % i)
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Routes the requests to the FakeEdx of the server
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, endpoint, body, content_type='application/json',
+                  status=200, extra_headers=None, head=False):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (extra_headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+        self.server.site.count(endpoint, 0 if head else len(body))
+
+    def send_json(self, endpoint, obj, **kwargs):
+        self.send_body(endpoint, json.dumps(obj), **kwargs)
+
+    def send_file(self, endpoint, data, content_type, head=False):
+        """
+        Serve data honouring a single byte range
+        """
+        headers = {'Accept-Ranges': 'bytes', 'ETag': '"%d"' % len(data)}
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if start >= len(data):
+                headers['Content-Range'] = 'bytes */%d' % len(data)
+                return self.send_body(endpoint, b'', content_type, 416, headers, head)
+            end = min(end, len(data) - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+            return self.send_body(endpoint, data[start:end + 1], content_type, 206, headers, head)
+        return self.send_body(endpoint, data, content_type, 200, headers, head)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.route(head=False, post=True)
+
+    def do_GET(self):
+        self.route(head=False)
+
+    def do_HEAD(self):
+        self.route(head=True)
+
+    def route(self, head=False, post=False):
+        site = self.server.site
+        if site.latency:
+            time.sleep(site.latency)
+        path = unquote(urlparse(self.path).path)
+        shape = site.shape
+
+        if path == '/login':
+            return self.send_body('login_page', '<html>login</html>', 'text/html', head=head)
+        if path == '/csrf/api/v1/token':
+            return self.send_json('token', {'csrfToken': 'bench'},
+                                  extra_headers={'Set-Cookie': 'csrftoken=bench; Path=/'})
+        if path.startswith('/api/user/v2/account/login_session'):
+            return self.send_json('login', {'success': True},
+                                  extra_headers={'Set-Cookie': 'sessionid=bench; Path=/'})
+        if path == '/api/learner_home/init':
+            return self.send_json('course_list', site.course_list())
+        if path.startswith('/api/course_home/outline/'):
+            return self.send_json('outline', site.outline(path.rsplit('/', 1)[1]))
+        if path.startswith('/api/courseware/sequence/'):
+            return self.send_json('sequence', site.sequence(path.rsplit('/', 1)[1]))
+        if path.startswith('/xblock/'):
+            return self.send_body('xblock', site.xblock(path.rsplit('/', 1)[1]),
+                                  'text/html', head=head)
+        if path.startswith('/assets/'):
+            return self.send_file('asset', _payload(path, shape.asset_size),
+                                  'application/pdf', head)
+        if path.startswith('/media/'):
+            return self.send_file('mp4', _payload(path, shape.mp4_size), 'video/mp4', head)
+        if path.startswith('/hls/'):
+            _, _, video, name = path.split('/', 3)
+            if name == 'master.m3u8':
+                return self.send_body('hls_playlist', site.master_playlist(video),
+                                      'application/vnd.apple.mpegurl', head=head)
+            if name.endswith('.m3u8'):
+                return self.send_body('hls_playlist', site.media_playlist(video),
+                                      'application/vnd.apple.mpegurl', head=head)
+            return self.send_file('hls_segment', _payload(path, shape.segment_size),
+                                  'video/mp2t', head)
+        if path.startswith('/transcript/'):
+            _, _, video, lang = path.split('/', 3)
+            if lang == 'available':
+                return self.send_json('transcript', shape.languages)
+            return self.send_json('transcript', site.transcript(video, lang))
+        self.send_body('not_found', b'', 'text/plain', 404, head=head)
+
+
+def start_server(shape, latency=0.0, port=0):
+    """
+    Start the fake site in a background thread, returns the server
+    """
+    site = FakeEdx(shape, latency)
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.site = site
+    site.base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def add_shape_arguments(parser):
+    parser.add_argument('--courses', type=int, default=1)
+    parser.add_argument('--chapters', type=int, default=4)
+    parser.add_argument('--sequentials', type=int, default=4,
+                        help='sequentials per chapter')
+    parser.add_argument('--verticals', type=int, default=4,
+                        help='verticals per sequential')
+    parser.add_argument('--videos', type=int, default=1,
+                        help='videos per vertical')
+    parser.add_argument('--assets', type=int, default=1,
+                        help='pdf assets per vertical')
+    parser.add_argument('--mp4-size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--segments', type=int, default=10,
+                        help='HLS segments per video')
+    parser.add_argument('--segment-size', type=int, default=128 * 1024)
+    parser.add_argument('--cues', type=int, default=500,
+                        help='transcript cues per language')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='delay added to every request, in seconds')
+
+
+def shape_from_args(args):
+    return CourseShape(courses=args.courses, chapters=args.chapters,
+                       sequentials=args.sequentials, verticals=args.verticals,
+                       videos=args.videos, assets=args.assets,
+                       mp4_size=args.mp4_size, segments=args.segments,
+                       segment_size=args.segment_size, cues=args.cues)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in edX server')
+    parser.add_argument('--port', type=int, default=8000)
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_server(shape_from_args(args), args.latency, args.port)
+    print('Serving fake edX on %s' % server.site.base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmarks of edxdlr against the local fake edX server
+
+Every configuration downloads the same synthetic course(s) into a fresh
+directory, in its own process, and reports:
+
+* outline build time (get_available_blocks)
+* extraction rate (extract_units calls per second)
+* download throughput (bytes written per second of download phase)
+* peak RSS of the main process and of the largest worker process
+* requests served, per endpoint
+
+Examples:
+
+    python bench/run_bench.py --chapters 10 --latency 0.05
+    python bench/run_bench.py --configs serial,asyncio --json bench.json
+    python bench/run_bench.py --edxdlr-args="--with-subtitles --download-m3u8"
+    python bench/run_bench.py --micro
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+import fake_edx
+
+# name -> extra edxdlr arguments
+CONFIGS = {
+    'serial': [],
+    'process': ['--process', '4'],
+    'asyncio': ['--engine', 'asyncio', '--process', '16'],
+    'small-first': ['--process', '4', '--order', 'small-first'],
+    'large-first': ['--process', '4', '--order', 'large-first'],
+}
+
+# files of edxdlr itself, not counted as downloaded bytes
+BOOKKEEPING_FILES = ('edx-dl.cache', 'edx-dl.state')
+
+
+def _max_rss_mb(usage):
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss / (1024.0 * 1024.0)
+    return usage.ru_maxrss / 1024.0
+
+
+def _dir_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.startswith(BOOKKEEPING_FILES):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+# ##### child side: one edxdlr run, instrumented
+
+def point_to(edxdlr, base_url):
+    """
+    Make edxdlr talk to base_url instead of edx.org
+    """
+    edxdlr.BASE_URL = base_url
+    edxdlr.EDX_HOMEPAGE = base_url
+    edxdlr.LOGIN_PAGE = base_url + '/login'
+    edxdlr.LOGIN_API = base_url + '/api/user/v2/account/login_session/'
+    edxdlr.TOKEN_API = base_url + '/csrf/api/v1/token'
+    edxdlr.DASHBOARD_URL = base_url
+    edxdlr.LEARNING_URL = base_url
+    edxdlr.COURSE_LIST_JSON_API = base_url + '/api/learner_home/init'
+    edxdlr.COURSE_OUTLINE_JSON_API = base_url + '/api/course_home/outline'
+    edxdlr.COURSE_SEQUENCE_JSON_API = base_url + '/api/courseware/sequence'
+    edxdlr.COURSE_BLOCK_API = base_url + '/xblock'
+
+
+def run_child(base_url, edxdlr_argv):
+    """
+    Run edxdlr.main() with timers around the outline and extraction stages,
+    and print the measures as json on the last line of stdout
+    """
+    import multiprocessing
+    import threading
+    import edxdlr
+
+    # workers must inherit the patched module
+    if 'fork' in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method('fork')
+    point_to(edxdlr, base_url)
+
+    lock = threading.Lock()
+    measures = {'outline_seconds': 0.0, 'extract_calls': 0,
+                'extract_first': None, 'extract_last': None}
+
+    get_available_blocks = edxdlr.get_available_blocks
+    extract_units = edxdlr.extract_units
+
+    def timed_get_available_blocks(*args, **kwargs):
+        start = time.time()
+        try:
+            return get_available_blocks(*args, **kwargs)
+        finally:
+            measures['outline_seconds'] += time.time() - start
+
+    def timed_extract_units(*args, **kwargs):
+        start = time.time()
+        try:
+            return extract_units(*args, **kwargs)
+        finally:
+            end = time.time()
+            with lock:
+                measures['extract_calls'] += 1
+                if measures['extract_first'] is None:
+                    measures['extract_first'] = start
+                measures['extract_last'] = end
+
+    edxdlr.get_available_blocks = timed_get_available_blocks
+    edxdlr.extract_units = timed_extract_units
+
+    sys.argv = ['edxdlr'] + edxdlr_argv
+    start = time.time()
+    edxdlr.main()
+    measures['total_seconds'] = time.time() - start
+    measures['rss_main_mb'] = _max_rss_mb(resource.getrusage(resource.RUSAGE_SELF))
+    measures['rss_worker_mb'] = _max_rss_mb(resource.getrusage(resource.RUSAGE_CHILDREN))
+    sys.stdout.write('\n' + json.dumps(measures) + '\n')
+
+
+# ##### parent side
+
+def run_config(server, name, extra_args, common_args, keep):
+    site = server.site
+    before = site.stats()
+    output_dir = tempfile.mkdtemp(prefix='edxdlr-bench-%s-' % name)
+    course_ids = [site.shape.course_id(c) for c in range(site.shape.courses)]
+    argv = (['-u', 'bench', '-p', 'bench', '--quiet', '-o', output_dir]
+            + common_args + extra_args + course_ids)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', site.base_url, '--'] + argv
+    try:
+        process = subprocess.run(cmd, cwd=ROOT_DIR, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, universal_newlines=True)
+        if process.returncode != 0:
+            sys.stderr.write(process.stderr)
+            raise RuntimeError('configuration %s failed' % name)
+        measures = json.loads(process.stdout.strip().splitlines()[-1])
+        downloaded = _dir_size(output_dir)
+    finally:
+        if not keep:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    after = site.stats()
+    requests = {endpoint: count - before['requests'].get(endpoint, 0)
+                for endpoint, count in after['requests'].items()
+                if count - before['requests'].get(endpoint, 0)}
+    extract_span = 0.0
+    if measures['extract_calls']:
+        extract_span = measures['extract_last'] - measures['extract_first']
+    download_seconds = max(measures['total_seconds'] - measures['outline_seconds'], 1e-9)
+    return {
+        'config': name,
+        'args': extra_args,
+        'total_seconds': measures['total_seconds'],
+        'outline_seconds': measures['outline_seconds'],
+        'extract_calls': measures['extract_calls'],
+        'extract_per_second': measures['extract_calls'] / extract_span if extract_span else None,
+        'downloaded_bytes': downloaded,
+        'throughput_mb_s': downloaded / download_seconds / (1024.0 * 1024.0),
+        'rss_main_mb': measures['rss_main_mb'],
+        'rss_worker_mb': measures['rss_worker_mb'],
+        'requests': requests,
+    }
+
+
+def print_results(results):
+    header = '%-12s %8s %8s %10s %10s %9s %9s %8s' % (
+        'config', 'total s', 'outline', 'extract/s', 'MB/s', 'rss main', 'rss wkr', 'requests')
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        rate = r['extract_per_second']
+        print('%-12s %8.2f %8.2f %10s %10.2f %9.1f %9.1f %8d' % (
+            r['config'], r['total_seconds'], r['outline_seconds'],
+            '%.1f' % rate if rate else '-', r['throughput_mb_s'],
+            r['rss_main_mb'], r['rss_worker_mb'], sum(r['requests'].values())))
+
+
+# ##### micro benchmarks, in process
+
+def _time(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _legacy_extract_units(url, page):
+    # extract_units_from_html before the linear scan, for comparison
+    import html
+    import re
+    from common import Material, Video, WebPage
+
+    units = [WebPage(url, page)]
+    video_units = re.compile('(id="video_[0-9a-f]*".*?class="video closed".*?>.*?<\\/div>)', re.DOTALL)
+    for video_html in video_units.findall(page):
+        re_metadata = re.compile(r"data-metadata='(.*?)'")
+        for match_metadata in re_metadata.findall(video_html.replace('&#34;', '"')):
+            metadata = html.unescape(match_metadata)
+            units.append(Video(json.loads(html.unescape(metadata))))
+    file_units = re.compile('(<a href=\\"\\/assets.*?\\" target=\\"\\[object Object\\]\\">.*?<\\/a>)', re.DOTALL)
+    for file_html in file_units.findall(page):
+        for material_link in re.compile(r"href=\"(.*?)\"").findall(file_html):
+            units.append(Material(material_link))
+    return units
+
+
+def _describe_units(units):
+    return [(type(unit).__name__, vars(unit)) for unit in units]
+
+
+def micro_extract_units():
+    """
+    extract_units_from_html on a large page, and on pages of unterminated
+    video ids, the worst case of the former lazy DOTALL patterns; the former
+    extractor is timed on the large page and on the smaller unterminated one
+    """
+    from parsing import EdxExtractor
+
+    site = fake_edx.FakeEdx(fake_edx.CourseShape(videos=50, assets=200))
+    site.base_url = 'http://127.0.0.1'
+    page = site.xblock('block-v1:BenchX+C0+2024+type@vertical+block@large')
+    unterminated = '<div id="video_ab12" ' * 20000
+    # the former extractor is quadratic on it, keep it to a second or so
+    unterminated_small = '<div id="video_ab12" ' * 2000
+    extractor = EdxExtractor()
+
+    small = fake_edx.FakeEdx(fake_edx.CourseShape(videos=2, assets=2))
+    small.base_url = 'http://127.0.0.1'
+    small_page = small.xblock('block-v1:BenchX+C0+2024+type@vertical+block@small')
+    adversarial = [
+        # a video block without its class runs into the next one
+        small_page.replace('class="video closed"', 'class="video"', 1),
+        # an unterminated link runs into the next one
+        small_page.replace('</a>', '', 1),
+        # quotes of the metadata as &#34;
+        small_page.replace('&amp;quot;', '&#34;'),
+        # truncated in the middle of a video block and of a link
+        small_page[:small_page.index('data-metadata')],
+        small_page[:small_page.rindex('</a>')],
+        # links spanning lines, links to other places
+        '<a href="/assets/a.pdf" target="[object Object]">\nhandout\n</a>'
+        '<a href="/about">about</a>'
+        '<a href="/assets/b.pdf">no target</a> <a href="/assets/c.pdf" target="[object Object]">c</a>',
+        unterminated_small,
+    ]
+    for html_page in [page] + adversarial:
+        assert (_describe_units(_legacy_extract_units('u', html_page))
+                == _describe_units(extractor.extract_units_from_html('u', html_page, [])))
+
+    return {
+        'large_page_kb': len(page) / 1024.0,
+        'large_page_legacy_seconds': _time(lambda: _legacy_extract_units('u', page)),
+        'large_page_seconds': _time(lambda: extractor.extract_units_from_html('u', page, [])),
+        'unterminated_small_page_kb': len(unterminated_small) / 1024.0,
+        'unterminated_small_page_legacy_seconds':
+            _time(lambda: _legacy_extract_units('u', unterminated_small)),
+        'unterminated_small_page_seconds':
+            _time(lambda: extractor.extract_units_from_html('u', unterminated_small, [])),
+        'unterminated_page_kb': len(unterminated) / 1024.0,
+        'unterminated_page_seconds': _time(lambda: extractor.extract_units_from_html('u', unterminated, [])),
+    }
+
+
+def _legacy_json2srt(o):
+    # edx_json2srt before the integer conversion, for comparison
+    from datetime import datetime, timedelta
+
+    if o == {}:
+        return ''
+    base_time = datetime(1, 1, 1)
+    output = []
+    for i, (s, e, t) in enumerate(zip(o['start'], o['end'], o['text'])):
+        if t == '':
+            continue
+        output.append(str(i) + '\n')
+        s = base_time + timedelta(seconds=s/1000.)
+        e = base_time + timedelta(seconds=e/1000.)
+        time_range = "%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d\n" % \
+                     (s.hour, s.minute, s.second, s.microsecond/1000,
+                      e.hour, e.minute, e.second, e.microsecond/1000)
+        output.append(time_range)
+        output.append(t + "\n\n")
+    return ''.join(output)
+
+
+def micro_json2srt():
+    """
+    Conversion of a 10000 cue transcript: the former datetime based
+    edx_json2srt, the current one, and write_subtitles streaming srt and vtt
+    to a file
+    """
+    from parsing import edx_json2srt, write_subtitles
+
+    transcript = fake_edx.FakeEdx(fake_edx.CourseShape(cues=10000)).transcript(None, 'en')
+    assert _legacy_json2srt(transcript) == edx_json2srt(transcript)
+
+    def write(subtitle_format):
+        with open(os.devnull, 'w') as output:
+            write_subtitles(transcript, output, subtitle_format)
+
+    return {
+        'cues': len(transcript['start']),
+        'legacy_seconds': _time(lambda: _legacy_json2srt(transcript)),
+        'json2srt_seconds': _time(lambda: edx_json2srt(transcript)),
+        'write_srt_seconds': _time(lambda: write('srt')),
+        'write_vtt_seconds': _time(lambda: write('vtt')),
+    }
+
+
+def _build_outline(shape):
+    from parsing import EdxExtractor
+
+    site = fake_edx.FakeEdx(shape)
+    outline = site.outline(shape.course_id(0))
+    sequences = [site.sequence(name) for name in outline['course_blocks']['blocks']
+                 if 'type@sequential' in name]
+    extractor = EdxExtractor()
+
+    def build():
+        blocks = extractor.extract_sequential_blocks_from_json(outline)
+        for sequence in sequences:
+            extractor.extract_vertical_blocks_from_sequential(blocks, sequence, 'u')
+        return blocks, extractor.sort_blocks(blocks)
+    return build
+
+
+def micro_outline():
+    """
+    Outline handling of a synthetic course of about 10k and 100k blocks:
+    building and sorting the tree, the traversals and the tree view. The
+    times should grow linearly with the number of blocks.
+    """
+    import tracemalloc
+
+    results = {}
+    for label, chapters in (('10k', 5), ('100k', 50)):
+        build = _build_outline(fake_edx.CourseShape(chapters=chapters, sequentials=40,
+                                                    verticals=50))
+        blocks, root = build()
+
+        def traverse():
+            for chapter in root.chapters():
+                for sequential in chapter.sequentials():
+                    sequential.verticals()
+            root.verticals()
+
+        tracemalloc.start()
+        build()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results['blocks_' + label] = len(blocks)
+        results['build_seconds_' + label] = _time(build, repeat=1)
+        results['traverse_seconds_' + label] = _time(traverse)
+        results['treeview_seconds_' + label] = _time(root.treeview)
+        results['peak_mb_' + label] = peak / (1024.0 * 1024.0)
+    return results
+
+
+MICRO_BENCHMARKS = {
+    'extract_units': micro_extract_units,
+    'json2srt': micro_json2srt,
+    'outline': micro_outline,
+}
+
+
+def run_micro():
+    results = {}
+    for name, benchmark in sorted(MICRO_BENCHMARKS.items()):
+        results[name] = benchmark()
+        print('%s: %s' % (name, ', '.join('%s=%.4g' % item
+                                            for item in sorted(results[name].items()))))
+    return results
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[4:])
+        return
+
+    parser = argparse.ArgumentParser(description='edxdlr end-to-end benchmarks')
+    fake_edx.add_shape_arguments(parser)
+    parser.add_argument('--configs', default=','.join(CONFIGS),
+                        help='comma separated configurations among: %s' % ', '.join(CONFIGS))
+    parser.add_argument('--edxdlr-args', default='',
+                        help='extra arguments given to every run, joined to the '
+                        'option with "=" since they start with a dash, e.g. '
+                        '--edxdlr-args="--with-subtitles --download-m3u8"')
+    parser.add_argument('--micro', action='store_true',
+                        help='run the in-process micro benchmarks only')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the downloaded files')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='write the results to this file')
+    args = parser.parse_args()
+
+    if args.micro:
+        results = {'micro': run_micro()}
+    else:
+        server = fake_edx.start_server(fake_edx.shape_from_args(args), args.latency)
+        results = {'shape': vars(fake_edx.shape_from_args(args)), 'runs': []}
+        try:
+            for name in args.configs.split(','):
+                results['runs'].append(run_config(server, name, CONFIGS[name],
+                                                  args.edxdlr_args.split(), args.keep))
+        finally:
+            server.shutdown()
+        print_results(results['runs'])
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
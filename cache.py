@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of extracted resources (--cache)
+
+The cache is a small sqlite database living in the output directory. It keeps
+the Block tree of each course and the units extracted from each vertical, so
+a rerun of an unchanged course does not need to fetch them again.
+"""
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from common import DEFAULT_CACHE_FILENAME
+from utils import mkdir_p
+
+
+class Cache(object):
+    """
+    Key/value store of pickled objects, grouped by course id
+    """
+    def __init__(self, directory, ttl=None):
+        """
+        @param directory: Directory where the cache file is created.
+        @type directory: str
+
+        @param ttl: Seconds after which an entry is considered stale, None
+            means that entries never expire.
+        @type ttl: float or None
+        """
+        mkdir_p(directory)
+        self.filename = os.path.join(directory, DEFAULT_CACHE_FILENAME)
+        self.ttl = ttl
+        # the cache is shared by the extractor threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.filename, timeout=30,
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                        'course_id TEXT NOT NULL, '
+                        'key TEXT NOT NULL, '
+                        'created REAL NOT NULL, '
+                        'data BLOB NOT NULL, '
+                        'PRIMARY KEY (course_id, key))')
+        self.db.commit()
+
+    def get(self, course_id, key, ttl=-1):
+        """
+        Return the object stored under key, or None if it is missing or stale.
+        ttl overrides the default time to live of the cache.
+        """
+        if ttl == -1:
+            ttl = self.ttl
+        with self.lock:
+            row = self.db.execute('SELECT created, data FROM cache '
+                                  'WHERE course_id=? AND key=?',
+                                  (course_id, key)).fetchone()
+        if row is None:
+            return None
+        created, data = row
+        if ttl is not None and time.time() - created > ttl:
+            logging.debug('[cache] stale %s', key)
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            # e.g. written by an older version with different classes
+            logging.debug('[cache] unreadable %s: %s', key, e)
+            return None
+
+    def set(self, course_id, key, value):
+        """
+        Store value under key for the given course.
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                            (course_id, key, time.time(), sqlite3.Binary(data)))
+            self.db.commit()
+
+    def invalidate(self, course_id):
+        """
+        Drop every entry of the given course.
+        """
+        logging.info('Invalidating cache for %s', course_id)
+        with self.lock:
+            self.db.execute('DELETE FROM cache WHERE course_id=?', (course_id,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -81,6 +81,7 @@ class ExitCode(object):
     NO_DOWNLOADABLE_VIDEO = 6
 
 DEFAULT_CACHE_FILENAME = 'edx-dl.cache'
+DEFAULT_STATE_FILENAME = 'edx-dl.state'
 DEFAULT_FILE_FORMATS = ['eps', 'pdf', 'txt', 'doc', 'xls', 'ppt',
                         'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'odg',
                         'zip', 'rar', 'gz', 'mp3', 'R', 'Rmd', 'ipynb', 'py']
@@ -89,7 +90,14 @@ DEFAULT_FILE_FORMATS = ['eps', 'pdf', 'txt', 'doc', 'xls', 'ppt',
 class Block(object):
     """
     A tree of Blocks
+
+    The root of a course indexes the blocks of its tree by type once the
+    tree is built (see index()), chapters(), sequentials() and verticals()
+    then read the index instead of walking the tree.
     """
+    __slots__ = ('position', 'name', 'type', 'id', 'url', 'resource',
+                 'childrenid', 'children', 'fingerprint', '_by_type')
+
     def __init__(self, position, content):
         self.position = position
         self.name = content['display_name']
@@ -103,6 +111,17 @@ class Block(object):
             self.childrenid = []
         
         self.children = None # wait to be sorted later
+        # digest of the block's metadata, used by --sync to detect changes
+        self.fingerprint = content.get('fingerprint')
+        self._by_type = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name, None) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # also restores the __dict__ of blocks pickled before __slots__
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
 
     def __repr__(self):
         return self.name + ": " + str(len(self.chapters())) + " chapters"
@@ -113,33 +132,42 @@ class Block(object):
             contents = contents + '[' + ','.join([c.treeview() for c in self.children]) + ']'
         return str(contents)
 
+    def walk(self, block_type=None):
+        """
+        Yields the blocks of the tree in depth first order, only those of
+        block_type if given
+        """
+        stack = [self]
+        while stack:
+            block = stack.pop()
+            if block_type is None or block.type == block_type:
+                yield block
+            if block.children:
+                stack.extend(reversed(block.children))
+
+    def index(self):
+        """
+        Index the blocks of the tree by type, to be called once the tree
+        is complete
+        """
+        by_type = {}
+        for block in self.walk():
+            by_type.setdefault(block.type, []).append(block)
+        self._by_type = by_type
+
+    def blocks_of_type(self, block_type):
+        if self._by_type is not None:
+            return list(self._by_type.get(block_type, ()))
+        return list(self.walk(block_type))
+
     def chapters(self):
-        if self.type == 'chapter':
-            chapter_block = [self]
-        else:
-            chapter_block = []
-        for x in self.children:
-            chapter_block = chapter_block + x.chapters()
-        return chapter_block
+        return self.blocks_of_type('chapter')
 
     def sequentials(self):
-        if self.type == 'sequential':
-            sequential_block = [self]
-        else:
-            sequential_block = []
-        for x in self.children:
-            sequential_block = sequential_block + x.sequentials()        
-        return sequential_block
+        return self.blocks_of_type('sequential')
 
     def verticals(self):
-        if self.type == 'vertical':
-            vertical_block = [self]
-        else:
-            vertical_block = []
-        for x in self.children:
-            vertical_block = vertical_block + x.verticals()
-        
-        return vertical_block
+        return self.blocks_of_type('vertical')
 
 class Unit(object):
     """
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed store of downloaded files (--dedup-store)
+
+Every file downloaded through the store is kept once under its sha256 digest,
+and an index maps the urls to the digests. A url seen before, in another
+vertical, course or run, is linked from the store instead of downloaded
+again, and a new url whose content is already stored is replaced by a link.
+
+The index also keeps the ETag each url was downloaded with, so that the
+caller can check that the stored copy is still current before linking it,
+see DedupStore.fetch.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+from utils import mkdir_p
+
+INDEX_FILENAME = 'index.db'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# linux ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# one store per directory and process, see get_store()
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _link_or_copy(src, dst):
+    # dst must not exist
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return
+    except (ImportError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    shutil.copyfile(src, dst)
+
+
+def link_file(src, dst):
+    """
+    Make dst a copy of src as cheaply as possible: a hardlink, else a
+    reflink, else a plain copy.
+
+    The copy is made under a temporary name and then renamed over dst, an
+    existing dst is never opened for writing: it may be a hardlink to a
+    stored object, shared with other courses.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp_filename = '%s.%d.%d.link' % (dst, os.getpid(), threading.get_ident())
+    try:
+        _link_or_copy(src, tmp_filename)
+        os.replace(tmp_filename, dst)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def file_digest(filename):
+    """
+    sha256 of the contents of filename
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DedupStore(object):
+    """
+    Files indexed by url and by content digest
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        mkdir_p(directory)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, INDEX_FILENAME),
+                                  timeout=30, check_same_thread=False)
+        # several worker processes write to the index
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls ('
+                        'url TEXT PRIMARY KEY, '
+                        'digest TEXT NOT NULL, '
+                        'etag TEXT)')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(urls)')]
+        if 'etag' not in columns:
+            # index created before the ETags were kept
+            try:
+                self.db.execute('ALTER TABLE urls ADD COLUMN etag TEXT')
+            except sqlite3.OperationalError:
+                # added by another process in the meantime
+                pass
+        self.db.commit()
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def fetch(self, url, filename, is_current=None):
+        """
+        Link the stored copy of url to filename. is_current(etag, size)
+        tells whether the copy, downloaded with that ETag (or None) and of
+        that size, is still the file at url.
+        Returns False if url is not in the store or its copy is outdated.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT digest, etag FROM urls WHERE url=?',
+                                  (url,)).fetchone()
+        if row is None:
+            return False
+        digest, etag = row
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            return False
+        if is_current is not None and not is_current(etag, os.path.getsize(path)):
+            logging.debug('[dedup] %s changed since it was stored', url)
+            return False
+        link_file(path, filename)
+        return True
+
+    def add(self, url, filename, etag=None):
+        """
+        Index the downloaded filename under url, with the ETag it was
+        downloaded with. If the same content is already stored, filename is
+        replaced by a link to it.
+        """
+        digest = file_digest(filename)
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            logging.debug('[dedup] %s already stored as %s', filename, digest)
+            link_file(path, filename)
+        else:
+            mkdir_p(os.path.dirname(path))
+            link_file(filename, path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)',
+                            (url, digest, etag))
+            self.db.commit()
+
+
+def get_store(directory):
+    """
+    Return the store in directory, opened once per process.
+    """
+    key = (os.getpid(), directory)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = DedupStore(directory)
+        return _stores[key]
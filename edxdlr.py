@@ -6,15 +6,24 @@ Main module for the edx-dl downloader.
 It corresponds to the cli interface
 """
 import argparse
+import asyncio
+import collections
+import functools
 import getpass
+import itertools
 import json
 import logging
 from logger import *
 import signal
 import os
+import queue
 import re
 import sys
+import threading
+import time
 import m3u8dl
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 
 #from six.moves.http_cookiejar import CookieJar
@@ -42,12 +51,12 @@ from common import (
     DEFAULT_FILE_FORMATS,
 )
 from parsing import (
-    edx_json2srt,
+    write_subtitles,
     EdxExtractor,
+    SUBTITLE_FORMATS,
 )
 from utils import (
     clean_filename,    
-    get_filename_from_prefix,
     get_page_contents,
     get_page_contents_as_json,
     post_page_contents,
@@ -55,6 +64,13 @@ from utils import (
     mkdir_p
 )
 import runtime
+import dedup
+import metrics
+import retry
+import scheduler
+import state
+import throttle
+from cache import Cache
 
 #CHANGES: redefining urls
 BASE_URL = 'https://courses.edx.org'
@@ -72,6 +88,26 @@ COURSE_BLOCK_API = BASE_URL + '/xblock'
 # for parallel downloading
 global pool
 
+# suffix of files being downloaded
+PARTIAL_SUFFIX = '.part'
+
+# suffix of files being downloaded over several connections, and of the
+# progress of their byte ranges
+SEGMENTS_SUFFIX = '.segments'
+SEGMENTS_PROGRESS_SUFFIX = '.segments.json'
+
+# bytes written at a time by the range fetchers of segmented downloads
+SEGMENT_CHUNK_SIZE = 1024 * 1024
+
+# concurrent transfers of --engine asyncio when --process is not given
+DEFAULT_ASYNC_TRANSFERS = 16
+
+# subtitle languages of a video downloaded at the same time
+SUBTITLE_WORKERS = 4
+
+# typical bytes of a unit when --order cannot tell its size
+DEFAULT_UNIT_SIZES = {'file': 1024 * 1024, 'video': 100 * 1024 * 1024}
+
 # ######## login issues ########
 
 def parse_args():
@@ -118,6 +154,21 @@ def parse_args():
                         default=False,
                         help='download subtitles with the videos')
 
+    parser.add_argument('--subtitle-langs',
+                        dest='subtitle_langs',
+                        action='store',
+                        default=None,
+                        help='comma separated languages of the subtitles to '
+                        'download, e.g. en,zh (default: all available)')
+
+    parser.add_argument('--subtitle-format',
+                        dest='subtitle_format',
+                        action='store',
+                        choices=SUBTITLE_FORMATS,
+                        default='srt',
+                        help='format of the subtitles files, transcripts not '
+                        'in the edX format are kept as srt (default: srt)')
+
     parser.add_argument('-o',
                         '--output-dir',
                         action='store',
@@ -184,7 +235,131 @@ def parse_args():
                         dest='process',
                         action='store',
                         default=None,
-                        help='speed up using multiple processes')
+                        help='speed up using multiple processes '
+                        '(number of concurrent transfers with --engine asyncio)')
+
+    parser.add_argument('--engine',
+                        dest='engine',
+                        action='store',
+                        choices=['pool', 'asyncio'],
+                        default='pool',
+                        help='parallel download engine: a pool of processes, '
+                        'or asyncio tasks in a single process (default: pool)')
+
+    parser.add_argument('--outline-workers',
+                        dest='outline_workers',
+                        action='store',
+                        type=int,
+                        default=8,
+                        help='number of sequences fetched concurrently '
+                        'while building the course outline (default: 8)')
+
+    parser.add_argument('--extract-workers',
+                        dest='extract_workers',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='number of unit pages fetched and parsed '
+                        'concurrently, independent of --process (default: 4)')
+
+    parser.add_argument('--order',
+                        dest='order',
+                        action='store',
+                        choices=scheduler.ORDERS,
+                        default='course',
+                        help='download order of the units: course order, '
+                        'small-first (documents before videos) or '
+                        'large-first (default: course)')
+
+    parser.add_argument('--order-window',
+                        dest='order_window',
+                        action='store',
+                        type=int,
+                        default=scheduler.DEFAULT_WINDOW,
+                        help='number of extracted units reordered together '
+                        'by --order (default: %d)' % scheduler.DEFAULT_WINDOW)
+
+    parser.add_argument('--pool-size',
+                        dest='pool_size',
+                        action='store',
+                        type=int,
+                        default=runtime.DEFAULT_POOL_SIZE,
+                        help='keep-alive connections kept per host, in each '
+                        'process (default: %d)' % runtime.DEFAULT_POOL_SIZE)
+
+    parser.add_argument('--http-retries',
+                        dest='http_retries',
+                        action='store',
+                        type=int,
+                        default=retry.DEFAULT_RETRIES,
+                        help='retries of page and api requests on network '
+                        'and server errors (default: %d)' % retry.DEFAULT_RETRIES)
+
+    parser.add_argument('--retry-budget',
+                        dest='retry_budget',
+                        action='store',
+                        type=float,
+                        default=retry.DEFAULT_BUDGET_RATIO,
+                        help='retries allowed per successful request over the '
+                        'whole run, past a small reserve: requests fail fast '
+                        'once it is spent (default: %g)' % retry.DEFAULT_BUDGET_RATIO)
+
+    parser.add_argument('--connections',
+                        dest='connections',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='split each large file into byte ranges fetched '
+                        'over this many connections (default: 1, no split)')
+
+    parser.add_argument('--split-threshold',
+                        dest='split_threshold',
+                        action='store',
+                        type=float,
+                        default=64,
+                        help='size in MB from which files are split over '
+                        '--connections (default: 64)')
+
+    parser.add_argument('--limit-rate',
+                        dest='limit_rate',
+                        action='store',
+                        type=throttle.parse_rate,
+                        default=None,
+                        help='total download rate of all the workers, '
+                        'e.g. 500K or 2M (bytes per second)')
+
+    parser.add_argument('--limit-rate-host',
+                        dest='limit_rate_host',
+                        action='append',
+                        type=throttle.parse_host_rate,
+                        default=[],
+                        metavar='HOST=RATE',
+                        help='download rate limit for one host, can be '
+                        'repeated')
+
+    parser.add_argument('--adaptive',
+                        dest='adaptive',
+                        action='store_true',
+                        default=False,
+                        help='adapt the number of active transfers and page '
+                        'fetches to the server: back off on 429, 5xx and slow '
+                        'responses, grow while they are fast')
+
+    parser.add_argument('--adaptive-latency',
+                        dest='adaptive_latency',
+                        action='store',
+                        type=float,
+                        default=2.0,
+                        help='response time in seconds above which --adaptive '
+                        'backs off (default: 2)')
+
+    parser.add_argument('--dedup-store',
+                        dest='dedup_store',
+                        action='store',
+                        default=None,
+                        help='directory of a store shared across courses and '
+                        'runs, files already in it are linked instead of '
+                        'downloaded again')
 
     parser.add_argument('--download-m3u8',
                         dest='m3u8',
@@ -192,11 +367,30 @@ def parse_args():
                         default=False,
                         help='download video using m3u8 (ffmpeg required)')
 
+    parser.add_argument('--segment-workers',
+                        dest='segment_workers',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='number of m3u8 segments of a video downloaded '
+                        'concurrently (default: 4)')
+
+    parser.add_argument('--hls-merge',
+                        dest='hls_merge',
+                        action='store',
+                        choices=['pipe', 'file'],
+                        default='pipe',
+                        help='how m3u8 segments are merged: streamed into '
+                        'ffmpeg, or through an intermediate .ts file '
+                        '(default: pipe)')
+
     parser.add_argument('--retry',
                         dest='retry',
                         action='store',
+                        type=int,
                         default=3,
-                        help='download retry times')
+                        help='download retry times, with an exponential '
+                        'backoff between them')
 
     parser.add_argument('--short-names',
                         dest='shorten',
@@ -210,6 +404,41 @@ def parse_args():
                         default=False,
                         help='create and use a cache of extracted resources')
 
+    parser.add_argument('--cache-ttl',
+                        dest='cache_ttl',
+                        action='store',
+                        type=float,
+                        default=24,
+                        help='hours before a cached resource is fetched again, '
+                        '0 to never expire (default: 24)')
+
+    parser.add_argument('--clear-cache',
+                        dest='clear_cache',
+                        action='store_true',
+                        default=False,
+                        help='invalidate the cache of the selected courses '
+                        'before downloading them')
+
+    parser.add_argument('--sync',
+                        dest='sync',
+                        action='store_true',
+                        default=False,
+                        help='only extract the units that are new or changed '
+                        'since the last download of the course')
+
+    parser.add_argument('--metrics-json',
+                        dest='metrics_json',
+                        action='store',
+                        default=None,
+                        help='write the timings and throughput of each stage '
+                        'to this json file at the end of the run')
+
+    parser.add_argument('--metrics-prom',
+                        dest='metrics_prom',
+                        action='store',
+                        default=None,
+                        help='write the same measures as a Prometheus textfile')
+
     parser.add_argument('--dry-run',
                         dest='dry_run',
                         action='store_true',
@@ -265,7 +494,9 @@ def edx_get_headers():
         """
         logging.info('Getting initial CSRF token.')
 
-        response = runtime.session.get(url)
+        response = retry.call(lambda: retry.check(runtime.get_session().get(
+                                  url, timeout=retry.TIMEOUT)),
+                              url)
 
         for cookie in response.cookies:
             if cookie.name == 'csrftoken':
@@ -293,12 +524,17 @@ def edx_login(email, password):
     """
     
     # simulate real request
-    response = runtime.session.get(LOGIN_PAGE, headers=runtime.headers)
+    response = retry.call(lambda: retry.check(runtime.get_session().get(
+                              LOGIN_PAGE, headers=runtime.headers, timeout=retry.TIMEOUT)),
+                          LOGIN_PAGE)
     
     # then real request
     logging.info('Logging into edX.org: %s', LOGIN_API)
     post_data = {'email_or_username': email, 'password': password}
-    response = runtime.session.post(LOGIN_API, data=post_data, headers=runtime.headers)
+    response = retry.call(lambda: retry.check(runtime.get_session().post(
+                              LOGIN_API, data=post_data, headers=runtime.headers,
+                              timeout=retry.TIMEOUT)),
+                          LOGIN_API, idempotent=False)
     
     if response.status_code != 200:
         failure_info = json.loads(response.text)
@@ -339,7 +575,7 @@ def get_username_from_cookies():
     """
     logging.info('Extracting user name from cookies.')
     page_extractor = EdxExtractor()    
-    return page_extractor.extract_username_from_cookie(runtime.session.cookies)
+    return page_extractor.extract_username_from_cookie(runtime.get_session().cookies)
     
 def get_courses_info_from_json():
     """
@@ -380,11 +616,31 @@ def parse_courses(args, available_courses):
 
 # ######## get blocks and sort them out
 
-def get_available_blocks(course_id):
+def _fetch_sequence(block_name):
+    """
+    Fetch the json of a single sequential block
+    """
+    url = COURSE_SEQUENCE_JSON_API + '/' + block_name
+    logging.debug("Extracting from " + url)
+    return get_page_contents_as_json(url, headers=runtime.headers)
+
+@metrics.timed('outline')
+def get_available_blocks(course_id, workers=1, refresh=False):
     """
     Extracts all blocks for a given course
+
+    The sequences are fetched with up to `workers` concurrent requests, but
+    they are attached to the tree in outline order, so the positions and the
+    children order are the same as when fetching them one by one.
+    With refresh, the outline is fetched again even if it is cached.
     """
     logging.debug("Extracting blocks for " + course_id)
+
+    if runtime.cache is not None and not refresh:
+        blocks = runtime.cache.get(course_id, 'outline')
+        if blocks is not None:
+            logging.debug("Using cached blocks for " + course_id)
+            return blocks
     
     url = COURSE_OUTLINE_JSON_API + '/' + course_id
     logging.debug("Extracting from " + url)    
@@ -393,16 +649,19 @@ def get_available_blocks(course_id):
     page_extractor = EdxExtractor()
     blocks = page_extractor.extract_sequential_blocks_from_json(page)
 
-    block_names = list(blocks.keys())
-    for i, block_name in enumerate(block_names, 1):
-        if block_name.find('type@sequential')>=0:
-            url = COURSE_SEQUENCE_JSON_API + '/' + block_name
-            logging.debug("Extracting from " + url)
-            page = get_page_contents_as_json(url, headers=runtime.headers)
+    sequential_names = [block_name for block_name in blocks.keys()
+                        if block_name.find('type@sequential')>=0]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # map() yields in submission order, whatever order requests finish
+        for page in executor.map(_fetch_sequence, sequential_names):
             blocks = page_extractor.extract_vertical_blocks_from_sequential(blocks, page, COURSE_BLOCK_API)
 
     blocks = page_extractor.sort_blocks(blocks);
-    logging.debug("Extracted blocks: " + blocks.treeview())
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        # the tree view of a large course is long to build
+        logging.debug("Extracted blocks: " + blocks.treeview())
+    if runtime.cache is not None:
+        runtime.cache.set(course_id, 'outline', blocks)
     return blocks
 
 def _display_chapters(block):
@@ -414,12 +673,21 @@ def _display_chapters(block):
     for i, chapter_block in enumerate(block.chapters(), 1):
         logging.info('%2d - %s', i, chapter_block.name)
 
-def extract_units(url, headers, file_formats):
+@metrics.timed('extract')
+def extract_units(url, headers, file_formats, course_id=None, refresh=False):
     """
     Parses a webpage and extracts its resources e.g. video_url, sub_url, etc.
+    The units are cached under course_id when the cache is enabled, with
+    refresh the page is parsed again even if it is cached.
     """
     logging.info("Processing '%s'", url)
 
+    if runtime.cache is not None and course_id is not None and not refresh:
+        units = runtime.cache.get(course_id, url)
+        if units is not None:
+            logging.debug("Using cached units for '%s'", url)
+            return units
+
     #post_data = urlencode({ 'show_title': 0, 
     #                        'show_bookmark_button': 0,
     #                        'recheck_access': 1,
@@ -428,6 +696,8 @@ def extract_units(url, headers, file_formats):
     page_extractor = EdxExtractor()
     units = page_extractor.extract_units_from_html(url, page, file_formats)
 
+    if runtime.cache is not None and course_id is not None and page:
+        runtime.cache.set(course_id, url, units)
     return units
 
 def parse_file_formats(args):
@@ -452,17 +722,40 @@ def parse_file_formats(args):
 
 # ####### download functions 
 
+# languages of the subtitles of each video, by translations url, for this run
+_available_subs = {}
+_available_subs_lock = threading.Lock()
+
+def _subtitle_languages(args):
+    """
+    Languages asked by --subtitle-langs, None for all of them
+    """
+    if not args.subtitle_langs:
+        return None
+    return set(lang.strip() for lang in args.subtitle_langs.split(',') if lang.strip())
+
+def get_available_subtitles(available_subs_url, headers):
+    """
+    Languages of the subtitles of a video. They are asked once per run
+    (and process) for each video, the answer is kept in _available_subs.
+    """
+    with _available_subs_lock:
+        if available_subs_url in _available_subs:
+            return _available_subs[available_subs_url]
+    try:
+        available_subs = get_page_contents_as_json(available_subs_url, headers)
+    except (HTTPError, requests.HTTPError):
+        available_subs = ['en']
+    with _available_subs_lock:
+        _available_subs[available_subs_url] = available_subs
+    return available_subs
+
 def get_subtitles_urls(available_subs_url, sub_template_url, headers):
     """
     Request the available subs and builds the urls to download subs
     """
     if available_subs_url is not None and sub_template_url is not None:
-        try:
-            available_subs = get_page_contents_as_json(available_subs_url,
-                                                       headers)
-        except HTTPError:
-            available_subs = ['en']
-
+        available_subs = get_available_subtitles(available_subs_url, headers)
         return {sub_lang: sub_template_url % sub_lang
                 for sub_lang in available_subs}
 
@@ -470,7 +763,7 @@ def get_subtitles_urls(available_subs_url, sub_template_url, headers):
         try:
             available_subs = get_page_contents(sub_template_url,
                                                        headers)
-        except HTTPError:
+        except (HTTPError, requests.HTTPError):
             available_subs = ['en']
 
         return {'en': sub_template_url}
@@ -479,40 +772,36 @@ def get_subtitles_urls(available_subs_url, sub_template_url, headers):
 
 def edx_get_subtitle(url, headers):
     """
-    Return a string with the subtitles content from the url or None if no
-    subtitles are available.
+    Return the subtitles from the url: the edX transcript as a dict, a
+    string for other formats, or None if no subtitles are available.
     """
     try:
         if ';' in url:  # non-JSON format (e.g. Stanford)
             return get_page_contents(url, headers)
         else:
-            json_object = get_page_contents_as_json(url, headers)
-            return edx_json2srt(json_object)
-    except URLError as exception:
+            return get_page_contents_as_json(url, headers)
+    except (URLError, requests.RequestException) as exception:
         logging.warn('edX subtitles (error: %s)', exception)
         return None
     except ValueError as exception:
-        logging.warn('edX subtitles (error: %s)', exception.message)
+        logging.warn('edX subtitles (error: %s)', exception)
         return None
 
-def _build_subtitles_downloads(args, video, target_dir, filename_prefix, headers):
+def _build_subtitles_downloads(args, video, video_filename, headers):
     """
-    Builds a dict {url: filename} for the subtitles, based on the
-    filename_prefix of the video
+    Builds a dict {url: filename} for the subtitles in the languages asked
+    by args.subtitle_langs, based on the filename of the video
     """
     downloads = {}
-    filename = get_filename_from_prefix(target_dir, filename_prefix)
+    target_dir, filename = os.path.split(os.path.splitext(video_filename)[0])
 
-    if filename is None:
-        logging.warn('No video downloaded for %s', filename_prefix)
-        return downloads
     if video.subs_template_url is None:
-        logging.warn('No subtitles downloaded for %s', filename_prefix)
+        logging.warn('No subtitles downloaded for %s', filename)
         return downloads
 
-    # This is a fix for the case of retrials because the extension would be
-    # .lang (from .lang.srt), so the matching does not detect correctly the
-    # subtitles name
+    # The video file used to be looked up on disk, where it could match a
+    # .lang.srt file of a retrial; the suffix is still cut so that the names
+    # match the subtitles downloaded by earlier runs
     re_is_subtitle = re.compile(r'(.*)(?:\.[a-z]{2})')
     match_subtitle = re_is_subtitle.match(filename)
     if match_subtitle:
@@ -524,21 +813,58 @@ def _build_subtitles_downloads(args, video, target_dir, filename_prefix, headers
     subtitles_download_urls = get_subtitles_urls(video.subs_available_url,
                                                  video.subs_template_url,
                                                  headers)
+    languages = _subtitle_languages(args)
     for sub_lang, sub_url in subtitles_download_urls.items():
-        subs_filename = os.path.join(target_dir,
-                                     filename + '.' + sub_lang + '.srt')
+        if languages and sub_lang not in languages:
+            continue
+        subtitle_format = args.subtitle_format
+        if ';' in sub_url:
+            # not an edX transcript, written as is (see edx_get_subtitle),
+            # under the extension these files always had
+            subtitle_format = 'srt'
+        subs_filename = os.path.join(target_dir, '%s.%s.%s' % (filename, sub_lang,
+                                                               subtitle_format))
         downloads[sub_url] = subs_filename
     return downloads
 
-def download_subtitle(url, filename, headers, args):
+def download_subtitles(args, video, video_filename, headers, executor, video_complete):
     """
-    Downloads the subtitle from the url and transforms it to the srt format
+    Resolves the subtitles of a video and downloads all the languages at
+    the same time, on the threads of executor. They are only written once
+    the future video_complete tells that the video is complete.
+    Returns whether they are all complete.
     """
-    subs_string = edx_get_subtitle(url, headers)
-    if subs_string:
-        full_filename = os.path.join(os.getcwd(), filename)
-        with open(full_filename, 'wb+') as f:
-            f.write(subs_string.encode('utf-8'))
+    sub_downloads = _build_subtitles_downloads(args, video, video_filename, headers)
+    f = functools.partial(download_subtitle, video_complete=video_complete)
+    return all(list(executor.map(lambda download: skip_or_download(dict([download]), headers,
+                                                                   args, f),
+                                 sub_downloads.items())))
+
+def download_subtitle(url, filename, headers, args, video_complete=None):
+    """
+    Downloads the subtitle from the url and writes it in the format of
+    args.subtitle_format, cue by cue. With a video_complete future, nothing
+    is written unless its video turns out complete.
+    """
+    start = time.time()
+    subs = edx_get_subtitle(url, headers)
+    elapsed = time.time() - start
+    try:
+        # the wait for the video is not part of the subtitle stage
+        if video_complete is not None and not video_complete.result():
+            return
+        if subs:
+            start = time.time()
+            partial_filename = filename + PARTIAL_SUFFIX
+            with open(partial_filename, 'w', encoding='utf-8', newline='') as f:
+                if isinstance(subs, dict):
+                    write_subtitles(subs, f, args.subtitle_format)
+                else:
+                    f.write(subs)
+            os.replace(partial_filename, filename)
+            elapsed += time.time() - start
+    finally:
+        metrics.add_time('subtitle', elapsed)
 
 def _build_url_downloads(args, urls, target_dir, filename_prefix):
     """
@@ -562,13 +888,152 @@ def _build_filename_from_url(args, url, target_dir, filename_prefix):
     filename = os.path.join(target_dir, filename + '.' + fileformat)
     return filename
 
-def download_url(url, filename, headers, args):
+def _get_total_size(response, offset):
+    """
+    Size of the whole file, from Content-Range when resuming, 0 if unknown
+    """
+    if response.status_code == 206:
+        content_range = response.headers.get('Content-Range', '')
+        total = content_range.rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else 0
+    return int(response.headers.get("Content-Length", 0))
+
+def _get_ranged_size(url, headers):
+    """
+    Size and ETag of the file at url if the server accepts byte ranges,
+    (0, None) otherwise
+    """
+    try:
+        r = retry.call(lambda: retry.check(runtime.get_session().head(
+                           url, headers=headers, allow_redirects=True, timeout=retry.TIMEOUT)),
+                       url)
+    except requests.RequestException:
+        return 0, None
+    if r.status_code != 200 or r.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return 0, None
+    return int(r.headers.get('Content-Length', 0)), r.headers.get('ETag')
+
+class RangeNotHonoured(IOError):
+    """
+    The server answered a range request with the whole file, e.g. because
+    the file changed since its ETag was taken
+    """
+
+def _load_segments(progress_filename, segments_filename, size, etag):
+    """
+    The ranges [start, position, end] left by an interrupted segmented
+    download of the same file, or None
+    """
+    try:
+        with open(progress_filename) as f:
+            progress = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if (progress.get('size') != size or progress.get('etag') != etag
+            or not os.path.exists(segments_filename)
+            or os.path.getsize(segments_filename) != size):
+        return None
+    return progress['ranges']
+
+def _save_segments(progress_filename, size, etag, ranges):
+    partial_filename = progress_filename + PARTIAL_SUFFIX
+    with open(partial_filename, 'w') as f:
+        json.dump({'size': size, 'etag': etag, 'ranges': ranges}, f)
+    os.replace(partial_filename, progress_filename)
+
+def download_url_segmented(url, filename, size, etag, headers, args):
+    """
+    Downloads the given url in filename over args.connections connections,
+    each one fetching its own byte range into a preallocated file.
+
+    The data goes to filename + SEGMENTS_SUFFIX, and the progress of every
+    range to filename + SEGMENTS_PROGRESS_SUFFIX: an interrupted download
+    resumes each range where it stopped, if the file kept its size and ETag.
+    RangeNotHonoured is raised if the server sends the whole file instead.
+    """
+    from tqdm.auto import tqdm
+
+    segments_filename = filename + SEGMENTS_SUFFIX
+    progress_filename = filename + SEGMENTS_PROGRESS_SUFFIX
+    ranges = _load_segments(progress_filename, segments_filename, size, etag)
+    if ranges is None:
+        with open(segments_filename, 'wb') as output:
+            output.truncate(size)
+        part_size = -(-size // args.connections)
+        ranges = [[start, start, min(start + part_size, size) - 1]
+                  for start in range(0, size, part_size)]
+        _save_segments(progress_filename, size, etag, ranges)
+    else:
+        logging.info('resuming the segmented download of %s', filename)
+
+    done = sum(position - start for start, position, end in ranges)
+    progress = tqdm(total=size, initial=done, unit='B', unit_scale=True, desc="")
+    lock = threading.Lock()
+
+    def fetch(byte_range):
+        start, _, end = byte_range
+
+        def fetch_rest():
+            # a retry, or a later run, only fetches the rest of this range
+            request_headers = dict(headers)
+            request_headers['Accept-Encoding'] = 'identity'
+            request_headers['Range'] = 'bytes=%d-%d' % (byte_range[1], end)
+            if etag:
+                # the ranges are only worth joining if the file did not change
+                request_headers['If-Range'] = etag
+            with throttle.slot('transfer') as transfer, \
+                    runtime.get_session().get(url, stream=True, headers=request_headers,
+                                              timeout=retry.TIMEOUT) as r:
+                transfer.observe(r)
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise RangeNotHonoured('range not honoured (%d)' % r.status_code)
+                with open(segments_filename, 'r+b') as output:
+                    output.seek(byte_range[1])
+                    for chunk in r.iter_content(SEGMENT_CHUNK_SIZE):
+                        throttle.consume(url, len(chunk))
+                        output.write(chunk)
+                        output.flush()
+                        with lock:
+                            byte_range[1] += len(chunk)
+                            _save_segments(progress_filename, size, etag, ranges)
+                        progress.update(len(chunk))
+            if byte_range[1] != end + 1:
+                raise retry.TransientError('incomplete range, got %d of %d bytes'
+                                           % (byte_range[1] - start, end + 1 - start))
+
+        if byte_range[1] <= end:
+            retry.call(fetch_rest, '%s [%d-%d]' % (url, start, end), retries=args.retry)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            list(executor.map(fetch, ranges))
+    finally:
+        progress.close()
+    metrics.add_bytes('download', size - done)
+    os.replace(segments_filename, filename)
+    os.remove(progress_filename)
+
+def _discard_partial(filename):
+    """
+    Removes what interrupted downloads of filename left behind
+    """
+    for suffix in (PARTIAL_SUFFIX, SEGMENTS_SUFFIX, SEGMENTS_PROGRESS_SUFFIX):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+def fetch_url(url, filename, headers, args):
     """
     Downloads the given url in filename.
+
+    The data goes to filename + PARTIAL_SUFFIX, and an interrupted transfer is
+    resumed from there with a Range request. The file gets its final name
+    only once its length matches the size announced by the server.
+    Large files are fetched over several connections instead, see
+    download_url_segmented.
     """
     import requests
     from tqdm.auto import tqdm
-    import shutil
     # FIXME: Ugly hack for coping with broken SSL sites:
     # https://www.cs.duke.edu/~angl/papers/imc10-cloudcmp.pdf
     #
@@ -581,33 +1046,136 @@ def download_url(url, filename, headers, args):
     # Note: The mess with various exceptions being caught (and their
     # order) is due to different behaviors in different Python versions
     # (e.g., 2.7 vs. 3.4).
-    attempts = 0
-    success = False
-    while not success and attempts <= args.retry:
-
-        attempts = attempts + 1        
-        try:            
-            with requests.get(url, stream=True, headers=headers) as r:
-                total_size = int(r.headers.get("Content-Length", 0))
-                with tqdm.wrapattr(r.raw, "read", total=total_size, desc="") as data:
-                    with open(filename, 'wb')as output:
-                        shutil.copyfileobj(data, output)
-            success = True
-        except requests.ConnectionError as e:            
-            logging.warning('\nNetwork error (%s), retrying [%d]', e, attempts)
-        except Exception as e:
-            logging.error('error occured, retrying [%d]: %s', attempts, e)
+    partial_filename = filename + PARTIAL_SUFFIX
+    segmented = (not os.path.exists(partial_filename)
+                 and (args.connections > 1
+                      or os.path.exists(filename + SEGMENTS_PROGRESS_SUFFIX)))
+    download_state = state.get_state(args.output_dir)
+
+    def fetch():
+        # resume from whatever a previous attempt (or run) left behind
+        offset = 0
+        if os.path.exists(partial_filename):
+            offset = os.path.getsize(partial_filename)
+        request_headers = dict(headers)
+        # byte offsets must refer to the file, not to a compressed stream
+        request_headers['Accept-Encoding'] = 'identity'
+        if offset:
+            request_headers['Range'] = 'bytes=%d-' % offset
+            # only resume if the file did not change in between
+            resource = download_state.get(filename)
+            if resource and resource['etag']:
+                request_headers['If-Range'] = resource['etag']
+
+        with throttle.slot('transfer') as transfer, \
+                runtime.get_session().get(url, stream=True, headers=request_headers,
+                                          timeout=retry.TIMEOUT) as r:
+            transfer.observe(r)
+            if offset and r.status_code == 416:
+                # the partial file is not a prefix of this file anymore
+                os.remove(partial_filename)
+                raise retry.TransientError('cannot resume %s, restarting' % partial_filename)
+            r.raise_for_status()
+            if r.status_code != 206:
+                # the server ignored the range, start over
+                offset = 0
+            if r.headers.get('ETag'):
+                download_state.set_etag(filename, r.headers['ETag'])
+            total_size = _get_total_size(r, offset)
+            with tqdm.wrapattr(r.raw, "read", total=total_size, initial=offset, desc="") as data:
+                with open(partial_filename, 'ab' if offset else 'wb') as output:
+                    throttle.copy(url, data, output)
+
+        size = os.path.getsize(partial_filename)
+        metrics.add_bytes('download', size - offset)
+        if total_size and size != total_size:
+            raise retry.TransientError('incomplete download, got %d of %d bytes'
+                                       % (size, total_size))
+        os.replace(partial_filename, filename)
+
+    def fetch_segmented():
+        size, etag = _get_ranged_size(url, headers)
+        if not size or size < args.split_threshold * 1024 * 1024:
+            return False
+        try:
+            download_url_segmented(url, filename, size, etag, headers, args)
+            if etag:
+                download_state.set_etag(filename, etag)
+        except RangeNotHonoured as e:
+            logging.warning('segmented download failed (%s), '
+                            'falling back to a single stream', e)
+            for name in (filename + SEGMENTS_SUFFIX, filename + SEGMENTS_PROGRESS_SUFFIX):
+                if os.path.exists(name):
+                    os.remove(name)
+            return False
+        return True
 
-    if not success:
-        os.remove(filename)
+    try:
+        if not (segmented and fetch_segmented()):
+            retry.call(fetch, url, retries=args.retry)
+    except Exception:
+        # the partial files are kept, the next run resumes from them
         if not args.ignore_errors:
             logging.error('error: failed to download %s', url)
             logging.warning('Hint: if you want to ignore this error, add '
                         '--ignore-errors option to the command line')
-            raise e
+            raise
         else:
             logging.warning('error ignored: failed to download %s', url)
 
+def _is_current(url, headers, etag, size):
+    """
+    Whether a copy of url downloaded with etag (or None) and of the given
+    size is still the file at url, from a HEAD request
+    """
+    request_headers = dict(headers)
+    request_headers['Accept-Encoding'] = 'identity'
+    if etag:
+        request_headers['If-None-Match'] = etag
+
+    def head():
+        with throttle.slot('page') as page:
+            response = runtime.get_session().head(url, headers=request_headers,
+                                                  allow_redirects=True,
+                                                  timeout=retry.TIMEOUT)
+            page.observe(response)
+        return retry.check(response)
+
+    try:
+        r = retry.call(head, url)
+    except requests.RequestException as e:
+        logging.debug('cannot check %s (%s)', url, e)
+        return False
+    if r.status_code == 304:
+        return True
+    if r.status_code != 200:
+        return False
+    if etag and r.headers.get('ETag'):
+        return r.headers['ETag'] == etag
+    return r.headers.get('Content-Length') == str(size)
+
+@metrics.timed('download')
+def download_url(url, filename, headers, args):
+    """
+    Downloads the given url in filename, through the dedup store if any:
+    a url already in the store is linked from it instead of downloaded,
+    once a HEAD request tells that it did not change since.
+    """
+    if not args.dedup_store:
+        fetch_url(url, filename, headers, args)
+        return
+
+    store = dedup.get_store(args.dedup_store)
+    if store.fetch(url, filename,
+                   lambda etag, size: _is_current(url, headers, etag, size)):
+        logging.info('[dedup] %s => %s', url, filename)
+        return
+    fetch_url(url, filename, headers, args)
+    # with --ignore-errors a failed download just leaves no file
+    if os.path.exists(filename):
+        resource = state.get_state(args.output_dir).get(filename)
+        store.add(url, filename, resource['etag'] if resource else None)
+
 def download_m3u8(url, filename, headers, args):
     """
     Downloads the given url in filename.
@@ -627,92 +1195,241 @@ def download_m3u8(url, filename, headers, args):
 def skip_or_download(downloads, headers, args, f=download_url):
     """
     downloads url into filename using download function f,
-    if filename exists it skips
+    if the state of the output directory says filename is complete it skips.
+    Returns whether all the files are complete.
     """
+    download_state = state.get_state(args.output_dir)
+    complete = True
     for url, filename in downloads.items():
-        if os.path.exists(filename):
+        if download_state.is_done(filename, url):
             logging.info('[skipping] %s => %s', url, filename)
             continue
         else:
             logging.info('[download] %s => %s', url, filename)
         if args.dry_run:
             continue
-        f(url, filename, headers, args)
-
-def download_video(video_unit, args, target_dir, filename_prefix, headers):
-
+        resource = download_state.get(filename)
+        if resource and resource['url'] not in (None, url):
+            # what is left of the file that had this name cannot be resumed
+            _discard_partial(filename)
+        download_state.plan(url, filename)
+        try:
+            f(url, filename, headers, args)
+        finally:
+            # with --ignore-errors a failed download just leaves no file
+            if os.path.exists(filename):
+                download_state.done(filename)
+            else:
+                download_state.fail(filename)
+                complete = False
+    return complete
+
+def _build_video_downloads(video_unit, args, target_dir, filename_prefix):
+    """
+    Builds the dict {url: filename} of a video and the function downloading
+    its urls
+    """
     if args.m3u8 and len(video_unit.video_m3u8_urls)>0: 
         # if m3u8 not exist, fallback to mp4
-        m3u8_downloads = _build_url_downloads(args, video_unit.video_m3u8_urls, target_dir, filename_prefix)
-        skip_or_download(m3u8_downloads, headers, args, download_m3u8)
+        downloads = _build_url_downloads(args, video_unit.video_m3u8_urls, target_dir, filename_prefix)
+        f = download_m3u8
     
     elif len(video_unit.video_mp4_urls)>0:
         
-        mp4_downloads = _build_url_downloads(args, video_unit.video_mp4_urls, target_dir, filename_prefix)
-        skip_or_download(mp4_downloads, headers, args)
+        downloads = _build_url_downloads(args, video_unit.video_mp4_urls, target_dir, filename_prefix)
+        f = download_url
     
     else: 
         # force video link as mp4 download
-        mp4_downloads = {url:
-                        _build_filename_from_url(args, url, target_dir, filename_prefix)+'.mp4'
-                        for url in video_unit.video_url}
-        skip_or_download(mp4_downloads, headers, args)
-        
-    if args.subtitles:
-        sub_downloads = _build_subtitles_downloads(args, video_unit, target_dir, filename_prefix, headers)
-        skip_or_download(sub_downloads, headers, args, download_subtitle)
+        downloads = {url:
+                     _build_filename_from_url(args, url, target_dir, filename_prefix)+'.mp4'
+                     for url in video_unit.video_url}
+        f = download_url
+    return downloads, f
+
+def download_video(video_unit, args, target_dir, filename_prefix, headers):
+
+    downloads, f = _build_video_downloads(video_unit, args, target_dir, filename_prefix)
+
+    if not args.subtitles or not downloads or args.dry_run:
+        return skip_or_download(downloads, headers, args, f)
+
+    # the subtitles are resolved and fetched while the video is transferring
+    video_complete = concurrent.futures.Future()
+    with ThreadPoolExecutor(max_workers=1 + SUBTITLE_WORKERS) as executor:
+        subtitles = executor.submit(download_subtitles, args, video_unit,
+                                    next(iter(downloads.values())), headers, executor,
+                                    video_complete)
+        complete = False
+        try:
+            complete = skip_or_download(downloads, headers, args, f)
+        finally:
+            video_complete.set_result(complete)
+            concurrent.futures.wait([subtitles])
+        return subtitles.result() and complete
 
 def save_webpage(content, filename, headers, args):
     with open(filename, 'w', encoding='utf8') as fp:
         fp.write(content)
 
-def skip_or_save(downloads, data, headers, args, f=save_webpage):
+def skip_or_save(downloads, data, headers, args, f=save_webpage, refresh=False):
     """
     downloads url into filename using download function f,
-    if filename exists it skips
+    if the state of the output directory says filename is complete it skips,
+    unless refresh is set because data is newer than the file.
+    Returns whether all the files are complete.
     """
+    download_state = state.get_state(args.output_dir)
+    complete = True
     for url, filename in downloads.items():
-        if os.path.exists(filename):
+        if not refresh and download_state.is_done(filename, url):
             logging.info('[skipping] %s => %s', url, filename)
             continue
         else:
             logging.info('[download] %s => %s', url, filename)
         if args.dry_run:
             continue
-        f(data, filename, headers, args)
-
-def download_page(webpage, args, target_dir, filename_prefix, headers):
+        download_state.plan(url, filename)
+        try:
+            f(data, filename, headers, args)
+        finally:
+            # with --ignore-errors a failed download just leaves no file
+            if os.path.exists(filename):
+                download_state.done(filename)
+            else:
+                download_state.fail(filename)
+                complete = False
+    return complete
+
+def download_page(webpage, args, target_dir, filename_prefix, headers, refresh=False):
     pagedownload = {webpage.url: os.path.join(target_dir, filename_prefix + '.html')}
-    skip_or_save(pagedownload, webpage.content, headers, args)
+    return skip_or_save(pagedownload, webpage.content, headers, args, refresh=refresh)
 
-def download_material(material_unit, args, target_dir, filename_prefix, headers):
+def _build_material_downloads(material_unit, target_dir, filename_prefix):
     file_type = material_unit.url.rsplit('.',1)[1]
-    file_downloads = {BASE_URL + material_unit.url: os.path.join(target_dir, filename_prefix + '.' + file_type)}
-    skip_or_download(file_downloads, headers, args)
+    return {BASE_URL + material_unit.url: os.path.join(target_dir, filename_prefix + '.' + file_type)}
+
+def download_material(material_unit, args, target_dir, filename_prefix, headers):
+    file_downloads = _build_material_downloads(material_unit, target_dir, filename_prefix)
+    return skip_or_download(file_downloads, headers, args)
 
 def download_unit(unit, args, target_dir, filename_prefix, headers):
     """
     Downloads the urls in unit based on args in the given target_dir
-    with filename_prefix
+    with filename_prefix. Returns whether all its files are complete.
     """
     if unit.type == 'video':
-        download_video(unit, args, target_dir, filename_prefix, headers)
+        return download_video(unit, args, target_dir, filename_prefix, headers)
     elif unit.type == 'html':
-        download_page(unit, args, target_dir, filename_prefix, headers)
+        return download_page(unit, args, target_dir, filename_prefix, headers)
     elif unit.type == 'file':
-        download_material(unit, args, target_dir, filename_prefix, headers)
+        return download_material(unit, args, target_dir, filename_prefix, headers)
+    return True
 
-def download_course(args, course_block, headers, file_formats):
+def _changed_verticals(args, course_block, verticals):
     """
-    Downloads all the resources based on the selections
+    Keeps the verticals that are new or whose fingerprint changed since the
+    last sync of the course
     """
-    logging.info('Downloading %s [%s] sequentially', course_block.name, course_block.id)
-    logging.info("Output directory: " + args.output_dir)
+    snapshot = state.get_state(args.output_dir).get_snapshot(course_block.id)
+    changed = [(target_dir, vertical_name, vertical)
+               for target_dir, vertical_name, vertical in verticals
+               if vertical.fingerprint is None
+               or snapshot.get(vertical.id) != vertical.fingerprint]
+    logging.info('Sync %s: %d of %d verticals are new or changed',
+                 course_block.id, len(changed), len(verticals))
+    return changed
+
+class SyncProgress(object):
+    """
+    The verticals that failed to be extracted or downloaded during a run.
+    Their fingerprints are left out of the sync snapshot, so that the next
+    --sync extracts them again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failed = set()
+        # (target_dir, vertical_name) -> vertical id, to find the vertical
+        # of a unit from its download_unit arguments
+        self.verticals = {}
+
+    def add_vertical(self, target_dir, vertical_name, vertical):
+        with self.lock:
+            self.verticals[(target_dir, vertical_name)] = vertical.id
+
+    def vertical_failed(self, vertical):
+        with self.lock:
+            self.failed.add(vertical.id)
+
+    def unit_failed(self, unit_args):
+        unit, args, target_dir, filename_prefix, headers = unit_args
+        # filename_prefix is the vertical name followed by the unit counter
+        vertical_name = filename_prefix.rsplit('-', 1)[0]
+        with self.lock:
+            self.failed.add(self.verticals[(target_dir, vertical_name)])
+
+    def succeeded(self, vertical):
+        with self.lock:
+            return vertical.id not in self.failed
+
+def save_sync_snapshot(args, course_block, progress):
+    """
+    Records the fingerprints of the verticals of a downloaded course, the
+    next --sync only extracts the verticals that differ. The verticals that
+    failed according to progress are not recorded.
+    """
+    if args.dry_run:
+        return
+    fingerprints = {vertical.id: vertical.fingerprint
+                    for vertical in course_block.verticals()
+                    if vertical.fingerprint is not None and progress.succeeded(vertical)}
+    state.get_state(args.output_dir).save_snapshot(course_block.id, fingerprints)
+
+def _extract_vertical(args, course_block, headers, file_formats, progress,
+                      target_dir, vertical_name, vertical):
+    """
+    Extracts the units of a vertical as the arguments of download_unit.
+    The page of the vertical is written to its file right away, so its html
+    is not kept in memory until a worker gets to it: only the other units,
+    which are small descriptors of what to download, are returned.
+    A vertical that cannot be fetched or saved is recorded in progress.
+
+    With --sync only the new or changed verticals get here, and their page
+    was fetched again: it replaces the saved one. Their other units are
+    downloaded again if their file name now belongs to another url, e.g.
+    after a unit was inserted before them; the files named after former
+    positions are left in place.
+    """
+    try:
+        vunits = extract_units(vertical.url, headers, file_formats, course_block.id, args.sync)
+    except requests.RequestException as e:
+        # the other units are still worth downloading
+        logging.warning('skipping %s (%s)', vertical.url, e)
+        progress.vertical_failed(vertical)
+        return []
+    units = []
+    for counter, unitobj in enumerate(vunits):
+        filename_prefix = vertical_name + '-' + ("%02d" % (counter))
+        if unitobj.type == 'html':
+            if not download_page(unitobj, args, target_dir, filename_prefix, headers,
+                                 refresh=args.sync):
+                progress.vertical_failed(vertical)
+            continue
+        units.append((unitobj, args, target_dir, filename_prefix, headers))
+    return units
+
+def iter_course_units(args, course_block, headers, file_formats, progress):
+    """
+    Walks the course tree and yields the arguments of download_unit for each
+    unit, in course order. The verticals that fail are recorded in progress.
 
+    The pages of the verticals are fetched, parsed and saved by a pool of
+    args.extract_workers threads, a few verticals ahead of the consumer.
+    """
     coursename = clean_filename(course_block.name)
     base_dir = os.path.join(args.output_dir, coursename)
 
-    # Download Videos
+    verticals = []
     for c,chapter in enumerate(course_block.children):
         chapter_dirname = clean_filename("%02d-%s" % (c+1, chapter.name))
         if args.shorten:
@@ -728,13 +1445,103 @@ def download_course(args, course_block, headers, file_formats):
                 vertical_name = clean_filename("%02d-%s" % (v+1,vertical.name))
                 if args.shorten:
                     vertical_name = vertical_name[:32].strip()
-                vunits = extract_units(vertical.url, headers, file_formats) 
-                
-                counter = 0
-                for unitobj in vunits:
-                    filename_prefix = vertical_name + '-' + ("%02d" % (counter))
-                    download_unit(unitobj, args, target_dir, filename_prefix, headers)
-                    counter += 1 
+                verticals.append((target_dir, vertical_name, vertical))
+                progress.add_vertical(target_dir, vertical_name, vertical)
+
+    if args.sync:
+        verticals = _changed_verticals(args, course_block, verticals)
+
+    workers = max(1, args.extract_workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(target_dir, vertical_name, vertical):
+            future = executor.submit(_extract_vertical, args, course_block, headers,
+                                     file_formats, progress, target_dir, vertical_name,
+                                     vertical)
+            pending.append(future)
+
+        # keep a bounded window of verticals being extracted
+        pending = collections.deque()
+        remaining = iter(verticals)
+        for vertical_args in itertools.islice(remaining, 2 * workers):
+            submit(*vertical_args)
+
+        while pending:
+            vunits = pending.popleft().result()
+            for vertical_args in itertools.islice(remaining, 1):
+                submit(*vertical_args)
+            for unit_args in vunits:
+                yield unit_args
+
+def _get_content_length(url, headers):
+    """
+    Size of the file at url announced by the server, 0 if unknown
+    """
+    def head():
+        with throttle.slot('page') as page:
+            response = runtime.get_session().head(url, headers=headers, allow_redirects=True,
+                                                  timeout=retry.TIMEOUT)
+            page.observe(response)
+        return retry.check(response)
+    r = retry.call(head, url)
+    if r.status_code != 200:
+        return 0
+    return int(r.headers.get('Content-Length', 0))
+
+def estimate_unit_size(unit_args):
+    """
+    Estimated number of bytes downloaded for a unit, from the page itself,
+    a HEAD request or the HLS playlists. Falls back to a typical size of the
+    unit type, without probing, under --dry-run and for the units already
+    downloaded.
+    """
+    unit, args, target_dir, filename_prefix, headers = unit_args
+    default = DEFAULT_UNIT_SIZES.get(unit.type, 0)
+    if unit.type == 'file':
+        downloads = _build_material_downloads(unit, target_dir, filename_prefix)
+    elif unit.type == 'video':
+        downloads, _ = _build_video_downloads(unit, args, target_dir, filename_prefix)
+    else:
+        return default
+    download_state = state.get_state(args.output_dir)
+    if args.dry_run or all(download_state.is_done(filename, url)
+                           for url, filename in downloads.items()):
+        return default
+
+    size = 0
+    try:
+        if unit.type == 'file':
+            size = _get_content_length(BASE_URL + unit.url, headers)
+        elif unit.type == 'video':
+            if args.m3u8 and unit.video_m3u8_urls:
+                size = m3u8dl.estimate_size(unit.video_m3u8_urls[0], headers)
+            elif unit.video_mp4_urls or unit.video_url:
+                size = _get_content_length((unit.video_mp4_urls or unit.video_url)[0], headers)
+    except (requests.RequestException, ValueError) as e:
+        logging.debug('cannot estimate the size of %s (%s)', unit.type, e)
+    return size or default
+
+def iter_scheduled_units(args, course_block, headers, file_formats, progress):
+    """
+    iter_course_units, in the order asked by args.order
+    """
+    units = iter_course_units(args, course_block, headers, file_formats, progress)
+    if args.order == 'course':
+        return units
+    return scheduler.prioritize(units, args.order, estimate_unit_size,
+                                args.order_window, args.extract_workers)
+
+def download_course(args, course_block, headers, file_formats):
+    """
+    Downloads all the resources based on the selections
+    """
+    logging.info('Downloading %s [%s] sequentially', course_block.name, course_block.id)
+    logging.info("Output directory: " + args.output_dir)
+
+    progress = SyncProgress()
+    for unit_args in iter_scheduled_units(args, course_block, headers, file_formats, progress):
+        if not download_unit(*unit_args):
+            progress.unit_failed(unit_args)
+    save_sync_snapshot(args, course_block, progress)
 
 def ctrlc_handler(sig, frame):
     global pool
@@ -742,61 +1549,296 @@ def ctrlc_handler(sig, frame):
     pool.join()
     raise(KeyboardInterrupt)
 
-def pool_init(q):
+def pool_init(q, transport, limiter, adaptive, retry_policy):
     logger_init(q)
+    # all the workers draw from the same bandwidth, concurrency and retry budgets
+    throttle.configure(limiter)
+    throttle.configure_adaptive(adaptive)
+    retry.configure(retry_policy)
+    # forked workers start with a copy of the parent's measures
+    metrics.reset()
+    # share the parent's cookies, with a connection pool of our own
+    runtime.configure(transport)
     # make it responsive to Ctrl-C
     signal.signal(signal.SIGINT, ctrlc_handler)
 
-def download_course_parallel(args, course_block, headers, file_formats):
+def download_unit_measured(*unit_args):
     """
-    Downloads all the resources based on the selections
+    download_unit for pool workers: returns whether the unit is complete and
+    its measures, for the parent to aggregate
     """
-    logging.info('Processing %s [%s] ', course_block.name, course_block.id)
-    logging.info("Output directory: " + args.output_dir)
+    complete = download_unit(*unit_args)
+    return complete, metrics.drain()
 
-    coursename = clean_filename(course_block.name)
-    base_dir = os.path.join(args.output_dir, coursename)
+# sentinel telling the download side that the producer is done
+_END_OF_UNITS = None
+
+def _produce_units(units, unit_queue, stop):
+    """
+    Producer side of the pipeline: puts the units yielded by `units` into the
+    bounded unit_queue, blocking while the downloads are behind.
+    An exception raised while extracting is handed over through the queue.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                unit_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    # Download Videos
     try:
-        argslist = []
-        for c,chapter in enumerate(course_block.children):
-            chapter_dirname = clean_filename("%02d-%s" % (c+1, chapter.name))
-            for s,sequential in enumerate(chapter.children):
-                sequential_dirname = clean_filename("%02d-%s" % (s+1, sequential.name))
-                target_dir = os.path.join(base_dir,chapter_dirname,sequential_dirname)
-                mkdir_p(target_dir)
-        
-                for v,vertical in enumerate(sequential.children):
-                    vertical_name = clean_filename("%02d-%s" % (v+1,vertical.name))
-                    vunits = extract_units(vertical.url, headers, file_formats) 
-
-                    counter = 0
-                    for unitobj in vunits:
-                        filename_prefix = vertical_name + '-' + ("%02d" % (counter))
-                        argslist.append((unitobj, args, target_dir, filename_prefix, headers))
-                        counter += 1
-        
+        for unit_args in units:
+            if not put(unit_args):
+                return
+    except Exception as e:
+        put(e)
+    put(_END_OF_UNITS)
+
+def _iter_courses_units(args, course_blocks, headers, file_formats, progress):
+    """
+    The units of all the courses interleaved, as (course index, unit args).
+    (course index, _END_OF_UNITS) tells that all the units of that course
+    have been yielded.
+    """
+    def course_units(index, course_block):
+        for unit_args in iter_scheduled_units(args, course_block, headers, file_formats,
+                                              progress):
+            yield index, unit_args
+        yield index, _END_OF_UNITS
+
+    return scheduler.round_robin(course_units(index, course_block)
+                                 for index, course_block in enumerate(course_blocks))
+
+def download_courses_parallel(args, course_blocks, headers, file_formats):
+    """
+    Downloads all the resources of the courses based on the selections
+
+    Extraction and downloading are pipelined: a producer thread extracts the
+    units of each vertical into a bounded queue, while the pool is already
+    downloading the units extracted before. The pool is shared by all the
+    courses, which take turns to queue their units.
+    """
+    for course_block in course_blocks:
         logging.info('Downloading %s [%s] in parallel', course_block.name, course_block.id)
+    logging.info("Output directory: " + args.output_dir)
+
+    processes = int(args.process)
+    unit_queue = queue.Queue(maxsize=2 * processes)
+    # bounds the units submitted to the pool but not finished yet
+    in_flight = threading.BoundedSemaphore(2 * processes)
+    stop = threading.Event()
+    errors = []
+    # units of each course submitted but not finished, and courses whose
+    # units have all been submitted
+    outstanding = collections.Counter()
+    extracted = set()
+    finished = set()
+    lock = threading.Lock()
+    progress = SyncProgress()
+
+    def unit_done(index, unit_args, result):
+        complete, measures = result
+        if not complete:
+            progress.unit_failed(unit_args)
+        metrics.merge(measures)
+        with lock:
+            outstanding[index] -= 1
+        in_flight.release()
+
+    def unit_failed(e):
+        errors.append(e)
+        in_flight.release()
+
+    def save_finished_courses():
+        with lock:
+            done = [index for index in extracted - finished if not outstanding[index]]
+        for index in done:
+            finished.add(index)
+            save_sync_snapshot(args, course_blocks[index], progress)
+
+    q_listener, q = setup_logger()
+    global pool
+    pool = Pool(processes, pool_init, [q, runtime.transport_config(), throttle.limiter,
+                                   throttle.adaptive, retry.policy])
+    producer = threading.Thread(target=_produce_units,
+                                args=(_iter_courses_units(args, course_blocks, headers,
+                                                          file_formats, progress),
+                                      unit_queue, stop),
+                                daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = unit_queue.get()
+            if item is _END_OF_UNITS:
+                break
+            if isinstance(item, Exception):
+                raise item
+            index, unit_args = item
+            if unit_args is _END_OF_UNITS:
+                extracted.add(index)
+                continue
+            in_flight.acquire()
+            if errors:
+                raise errors[0]
+            save_finished_courses()
+            with lock:
+                outstanding[index] += 1
+            pool.apply_async(download_unit_measured, unit_args,
+                             callback=functools.partial(unit_done, index, unit_args),
+                             error_callback=unit_failed)
+
+        pool.close()
+        pool.join()
+        if errors:
+            raise errors[0]
+        save_finished_courses()
 
-        q_listener, q = setup_logger()
-        global pool
-        pool = Pool(int(args.process), pool_init, [q])
-        pool.starmap(download_unit, argslist)
-        
     except KeyboardInterrupt:
         pool.terminate()
         pool.join()
         logging.warn("\n\nCTRL-C detected, shutting down....")
 
+    except Exception:
+        pool.terminate()
+        raise
+
     finally:
+        stop.set()
         pool.close()
         pool.join()
+        q_listener.stop()
+
+async def _download_units_async(units, concurrency, progress):
+    """
+    Runs download_unit for every unit yielded by `units` as asyncio tasks,
+    with at most `concurrency` of them transferring at the same time.
+    The units that are not complete are recorded in progress.
+    """
+    loop = asyncio.get_running_loop()
+    # the blocking transfers run in threads sharing this process' session
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    # the generator extracts pages, advance it from one thread at a time
+    producer = ThreadPoolExecutor(max_workers=1)
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+    errors = []
+
+    async def download(unit_args):
+        try:
+            if not await loop.run_in_executor(executor, download_unit, *unit_args):
+                progress.unit_failed(unit_args)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
 
-    q_listener.stop()
+    try:
+        while True:
+            await slots.acquire()
+            # fail fast, like the pool does
+            if errors:
+                raise errors[0]
+            unit_args = await loop.run_in_executor(producer, next, units, _END_OF_UNITS)
+            if unit_args is _END_OF_UNITS:
+                break
+            task = asyncio.ensure_future(download(unit_args))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+        if errors:
+            raise errors[0]
+    except BaseException:
+        # Ctrl-C or a failed unit: the transfers still running in the
+        # threads give up at their next chunk instead of blocking the exit
+        throttle.stop()
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        producer.shutdown(wait=False, cancel_futures=True)
+        try:
+            units.close()
+        except ValueError:
+            # still extracting in the producer thread, which is stopping
+            pass
+
+def download_courses_async(args, course_blocks, headers, file_formats):
+    """
+    Downloads all the resources of the courses based on the selections, in
+    a single process, using asyncio tasks instead of a pool of processes.
+    The courses take turns to queue their units, like with the pool.
+    """
+    concurrency = int(args.process) if args.process else DEFAULT_ASYNC_TRANSFERS
+    for course_block in course_blocks:
+        logging.info('Downloading %s [%s] with %d concurrent transfers',
+                     course_block.name, course_block.id, concurrency)
+    logging.info("Output directory: " + args.output_dir)
+
+    progress = SyncProgress()
+    units = (unit_args for _, unit_args
+             in _iter_courses_units(args, course_blocks, headers, file_formats, progress)
+             if unit_args is not _END_OF_UNITS)
+    asyncio.run(_download_units_async(units, concurrency, progress))
+    for course_block in course_blocks:
+        save_sync_snapshot(args, course_block, progress)
 
 # ####### main function
 
+def _metrics_endpoints():
+    """
+    Names of the edX endpoints in the request counts of the metrics
+    """
+    return {LOGIN_PAGE: 'login_page',
+            LOGIN_API: 'login',
+            TOKEN_API: 'token',
+            COURSE_LIST_JSON_API: 'course_list',
+            COURSE_OUTLINE_JSON_API: 'outline',
+            COURSE_SEQUENCE_JSON_API: 'sequence',
+            COURSE_BLOCK_API: 'xblock',
+            BASE_URL + '/assets': 'asset'}
+
+def build_limiter(args):
+    """
+    Builds the bandwidth limiter of the run, None if unlimited
+    """
+    host_rates = dict(args.limit_rate_host)
+    if not args.limit_rate and not host_rates:
+        return None
+    return throttle.Limiter(args.limit_rate, host_rates)
+
+def build_adaptive_limits(args):
+    """
+    Builds the adaptive concurrency limits of the run, {} if disabled.
+    They start low and grow up to the concurrency the options allow.
+    """
+    if not args.adaptive:
+        return {}
+    if args.engine == 'asyncio':
+        workers = int(args.process) if args.process else DEFAULT_ASYNC_TRANSFERS
+    else:
+        workers = int(args.process) if args.process else 1
+    transfers = workers * max(1, args.segment_workers, args.connections)
+    pages = max(1, args.outline_workers, args.extract_workers)
+    return {'transfer': throttle.AdaptiveLimit(transfers, initial=min(transfers, 2),
+                                               latency_target=args.adaptive_latency),
+            'page': throttle.AdaptiveLimit(pages, initial=min(pages, 2),
+                                           latency_target=args.adaptive_latency)}
+
+def write_metrics(args, wall_seconds):
+    """
+    Logs the per stage summary of the run and writes the requested reports
+    """
+    metrics.log_summary(wall_seconds)
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json, wall_seconds)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom, wall_seconds)
+
 def main():
     """
     Main program function
@@ -813,12 +1855,20 @@ def main():
         logging.error("You must supply username and password to log-in")
         sys.exit(ExitCode.MISSING_CREDENTIALS)
     
+    start_time = time.time()
+    metrics.register_endpoints(_metrics_endpoints())
+    throttle.configure(build_limiter(args))
+    throttle.configure_adaptive(build_adaptive_limits(args))
+    retry.configure(retry.RetryPolicy(args.http_retries,
+                                      budget=retry.RetryBudget(args.retry_budget)))
+
     # Prepare Headers and Session
-    runtime.initialize()
-    runtime.headers = edx_get_headers()
+    runtime.initialize(args.pool_size)
 
     # Login
-    response = edx_login(args.username, args.password)
+    with metrics.stage('login'):
+        runtime.headers = edx_get_headers()
+        response = edx_login(args.username, args.password)
     if response.status_code != 200:
         logging.error("login failed")
         sys.exit(ExitCode.WRONG_EMAIL_OR_PASSWORD)
@@ -835,11 +1885,17 @@ def main():
     available_courses = [course for course in courses if course.state == 'Started']
     selected_courses = parse_courses(args, available_courses)
 
+    if args.cache:
+        runtime.cache = Cache(args.output_dir, args.cache_ttl * 3600 or None)
+        if args.clear_cache:
+            for selected_course in selected_courses:
+                runtime.cache.invalidate(selected_course.id)
+
     # Get all course blocks
     runtime.headers.update({'Referer': LEARNING_URL})
     runtime.headers.update({'Origin': LEARNING_URL})
     all_blocks = {selected_course:
-                    get_available_blocks(selected_course.id)
+                    get_available_blocks(selected_course.id, args.outline_workers, args.sync)
                     for selected_course in selected_courses}
     for selected_course in selected_courses:
         _display_chapters(all_blocks[selected_course])
@@ -847,12 +1903,16 @@ def main():
     # Download all resources
     runtime.headers.update({'Referer': BASE_URL})
     runtime.headers.update({'Origin': BASE_URL})
-    if not args.process:   
-        for course_block in all_blocks.values():
-            download_course(args, course_block, runtime.headers, file_formats)
-    else:
-        for course_block in all_blocks.values():
-            download_course_parallel(args, course_block, runtime.headers, file_formats)
+    try:
+        if args.engine == 'asyncio':
+            download_courses_async(args, list(all_blocks.values()), runtime.headers, file_formats)
+        elif not args.process:   
+            for course_block in all_blocks.values():
+                download_course(args, course_block, runtime.headers, file_formats)
+        else:
+            download_courses_parallel(args, list(all_blocks.values()), runtime.headers, file_formats)
+    finally:
+        write_metrics(args, time.time() - start_time)
 
 if __name__ == '__main__':
     try:
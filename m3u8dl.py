@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 
-import requests
 import logging
 import os
 import re
 import subprocess
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from six.moves.urllib.parse import urljoin
 from utils import clean_filename
+import runtime
+import metrics
+import retry
+import throttle
+
+def _get(url, headers):
+    """
+    Get a playlist, an error status raises HTTPError
+    """
+    with throttle.slot('page') as page:
+        r = runtime.get_session().get(url, headers=headers, timeout=retry.TIMEOUT)
+        page.observe(r)
+    r.raise_for_status()
+    return r
 
 def get_m3u8_files(url, filename_prefix, headers, args):
     """
@@ -15,7 +30,7 @@ def get_m3u8_files(url, filename_prefix, headers, args):
     """
     logging.debug('[m3u8dl] reading %s', url)
     filenames = []
-    r = requests.get(url, headers=headers)
+    r = retry.call(lambda: _get(url, headers), url)
     m3u8_content = r.text
     for line in m3u8_content.splitlines():
         if line[0:1]!='#':
@@ -28,91 +43,152 @@ def get_m3u8_files(url, filename_prefix, headers, args):
     
     return filenames
 
+def download_segment(url, ts_filename, headers, args):
+    """
+    Download a single ts segment, retrying it on failure.
+    The segment is written under a temporary name first, so an interrupted
+    download is not mistaken for a complete segment on the next run.
+    Returns True on success.
+    """
+    if os.path.exists(ts_filename):
+        logging.debug('[m3u8dl] skipping %s', url)
+        return True
+
+    logging.debug('[m3u8dl] reading %s', url)
+
+    def fetch():
+        with throttle.slot('transfer') as transfer, \
+                runtime.get_session().get(url, headers=headers, timeout=retry.TIMEOUT,
+                                          stream=True) as r:
+            transfer.observe(r)
+            r.raise_for_status()
+            with open(ts_filename + '.part', "wb") as ts:
+                for chunk in r.iter_content(throttle.CHUNK_SIZE):
+                    throttle.consume(url, len(chunk))
+                    ts.write(chunk)
+                    metrics.add_bytes('hls', len(chunk))
+        os.replace(ts_filename + '.part', ts_filename)
+
+    try:
+        retry.call(fetch, url, retries=args.retry)
+        return True
+    except Exception as e:
+        logging.error('failed to get ts file %s (%s)', url, e)
+        return False
+
 def download_m3u8(url, filename, headers, args):
     """
     Retrieve and download the list of files.
+    Up to args.segment_workers segments are downloaded at the same time, the
+    returned files keep the order of the playlist.
     """
-    ok = True
-    ts_files = []
-    
     urls = get_m3u8_files(url, filename, headers, args)
 
-    for i in tqdm(range(len(urls))):
-        
-        ts_url = urls[i]
-        ts_filename = ts_url.split('/').pop()
+    segments = []
+    for ts_url in urls:
+        # resolve relative segment urls against the playlist url
+        segment_url = urljoin(url, ts_url)
+        ts_filename = filename + '-' + clean_filename(ts_url.split('/').pop())
+        segments.append((segment_url, ts_filename))
 
-        if ts_url[0:3]!='http': 
-            # add base url if omitted
-            url_base = url.rsplit('/',1)[0]
-            url = "{}/{}".format(url_base, ts_filename)
-        else:
-            url = ts_url
-        # construct file name
-        ts_filename = filename + '-' + clean_filename(ts_filename)
+    def download(segment):
+        return download_segment(segment[0], segment[1], headers, args)
 
-        if os.path.exists(ts_filename):
-            logging.debug('[m3u8dl] skipping %s', url)
-            ts_files.append(ts_filename)
-        else:
-            logging.debug('[m3u8dl] reading %s', url)
-            
-            attempts = 0
-            while attempts<=args.retry:
-                try:
-                    r = requests.get(url, headers=headers, timeout=10)
-                    if r.status_code == requests.codes.OK: 
-                        break
-                    logging.error('\nfailed to get ts file %s, retrying [%d]', url, attempts)
-                except requests.ConnectionError:
-                    logging.error('\nNetwork error, retrying [%d]', attempts)
-                attempts = attempts + 1
-                
-            if r.status_code == requests.codes.OK:
-                with open(ts_filename, "wb") as ts:
-                    ts.write(r.content)
-                    ts.close()
-                    ts_files.append(ts_filename)
-            else:
-                logging.error('failed to get ts file '+url)
-                ok = False
-
-    if not ok:
+    workers = max(1, args.segment_workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(tqdm(executor.map(download, segments), total=len(segments)))
+
+    if not all(results):
         return []
     else:
-        return ts_files
+        return [ts_filename for _, ts_filename in segments]
     
-def merge_m3u8_to_mp4(ts_files, mp4filename, args):
+def _remux(cmd, args):
     """
-    Downloads the given m3u8 url and merge it as mp4.
+    Run ffmpeg, errors are ignored if asked to
+    """
+    try:
+        devnull = open(os.devnull, 'w')
+        subprocess.check_call(cmd, shell=False, stdout=devnull, stderr=devnull) 
+        return True
+    except subprocess.CalledProcessError as e:
+        if args.ignore_errors:
+            logging.warn('[m3u8dl] ffmpeg failed, segments kept as-is')
+            return False
+        else:
+            raise e
+
+def merge_m3u8_to_file(ts_files, mp4filename, args):
+    """
+    Concatenate the segments into one .ts file and remux it as mp4.
     """
-    logging.debug('[m3u8dl] merge ts segments')
-    mp4filename = mp4filename.replace('.m3u8', '.mp4')
-    
-    # merge ts files and then convert, in case the cmd gets too long
     merged_filename = mp4filename.replace('.mp4', '.ts')
     with open(merged_filename, 'wb') as merged:
         for ts_file in ts_files:
             with open(ts_file, 'rb') as tsfile:
                 shutil.copyfileobj(tsfile, merged)
     # convert
+    cmd = ['ffmpeg', '-i', merged_filename, '-c:a', 'copy', '-c:v', 'copy', mp4filename]
     try:
-        devnull = open(os.devnull, 'w')
-        cmd = ['ffmpeg', '-i', merged_filename, '-c:a', 'copy', '-c:v', 'copy', mp4filename]
-        subprocess.check_call(cmd, shell=False, stdout=devnull, stderr=devnull) 
-        ts_files.append(merged_filename)
-    except subprocess.CalledProcessError as e:
+        if _remux(cmd, args):
+            ts_files.append(merged_filename)
+    except FileNotFoundError:
+        logging.warn('[m3u8dl] ffmpeg not found, merged segments kept in %s', merged_filename)
+    return ts_files
+
+def merge_m3u8_to_pipe(ts_files, mp4filename, args):
+    """
+    Stream the segments into ffmpeg's stdin, without an intermediate file.
+    Falls back to merge_m3u8_to_file if ffmpeg is not available.
+    """
+    cmd = ['ffmpeg', '-y', '-f', 'mpegts', '-i', 'pipe:0',
+           '-c:a', 'copy', '-c:v', 'copy', mp4filename]
+    devnull = open(os.devnull, 'w')
+    try:
+        ffmpeg = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE,
+                                  stdout=devnull, stderr=devnull)
+    except FileNotFoundError:
+        return merge_m3u8_to_file(ts_files, mp4filename, args)
+
+    try:
+        for ts_file in ts_files:
+            with open(ts_file, 'rb') as tsfile:
+                shutil.copyfileobj(tsfile, ffmpeg.stdin)
+        ffmpeg.stdin.close()
+    except BrokenPipeError:
+        # ffmpeg exited early, its return code tells why
+        pass
+    returncode = ffmpeg.wait()
+
+    if returncode != 0:
+        if os.path.exists(mp4filename):
+            os.remove(mp4filename)
         if args.ignore_errors:
-            logging.warn('[m3u8dl] ffmpeg not found, segments kept as-is')
-        else:
-            raise e
+            logging.warn('[m3u8dl] ffmpeg failed, segments merged as-is')
+            return merge_m3u8_to_file(ts_files, mp4filename, args)
+        raise subprocess.CalledProcessError(returncode, cmd)
     return ts_files
 
+@metrics.timed('hls_merge')
+def merge_m3u8_to_mp4(ts_files, mp4filename, args):
+    """
+    Merge the downloaded segments as mp4.
+    Returns the files that can be removed afterwards.
+    """
+    logging.debug('[m3u8dl] merge ts segments')
+    mp4filename = mp4filename.replace('.m3u8', '.mp4')
+
+    if args.hls_merge == 'file':
+        # merge ts files and then convert, in case the cmd gets too long
+        return merge_m3u8_to_file(ts_files, mp4filename, args)
+    return merge_m3u8_to_pipe(ts_files, mp4filename, args)
+
 def clear_ts_files(ts_files):
     logging.debug('[m3u8dl] clear ts files')
     for tsfile in ts_files:
         os.remove(tsfile)
 
+@metrics.timed('hls')
 def download_mp4(url, filename, headers, args):
     """
     Downloads the given m3u8 url and merge it as mp4.
@@ -133,7 +209,7 @@ def choose_max_resolution(url, headers, args):
     """
     logging.debug('[m3u8dl] reading %s', url)
     
-    r = requests.get(url, headers=headers)
+    r = retry.call(lambda: _get(url, headers), url)
     m3u8_content = r.text
     lines = m3u8_content.splitlines()
 
@@ -153,4 +229,29 @@ def choose_max_resolution(url, headers, args):
     if default_url[0:4]!='http':
         default_url = url_base + '/' + default_url
 
-    return default_url
\ No newline at end of file
+    return default_url
+
+def estimate_size(url, headers):
+    """
+    Estimated size in bytes of the video of a master playlist: the bandwidth
+    of the stream choose_max_resolution picks times its duration.
+    Returns 0 if the playlists do not tell.
+    """
+    lines = retry.call(lambda: _get(url, headers), url).text.splitlines()
+    resolution, bandwidth, media_url = 0, 0, None
+    for l in range(len(lines) - 1):
+        if lines[l].startswith('#EXT-X-STREAM-INF'):
+            r = re.search(r'RESOLUTION=(\d+)x(\d+)', lines[l])
+            b = re.search(r'[:,]BANDWIDTH=(\d+)', lines[l])
+            res = int(r[1]) * int(r[2]) if r else 0
+            if b and (media_url is None or res > resolution):
+                resolution, bandwidth, media_url = res, int(b[1]), lines[l + 1]
+    if media_url is None:
+        return 0
+
+    duration = 0.0
+    media_url = urljoin(url, media_url)
+    for line in retry.call(lambda: _get(media_url, headers), media_url).text.splitlines():
+        if line.startswith('#EXTINF:'):
+            duration += float(line[8:].split(',', 1)[0])
+    return int(bandwidth * duration / 8)
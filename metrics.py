@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-stage timings, byte counts and request counts of a run
+
+Every process accumulates its own measures. The pool workers hand theirs
+back to the parent with each result (see drain() and merge()), so the
+report written at the end of the run covers the whole job.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from six.moves.urllib.parse import urlparse
+
+_lock = threading.Lock()
+# stage -> {'calls': int, 'seconds': float, 'bytes': int}
+_stages = {}
+# endpoint -> number of requests
+_requests = {}
+# (url prefix, endpoint name), longest prefix first
+_endpoints = []
+
+
+def _stage(name):
+    if name not in _stages:
+        _stages[name] = {'calls': 0, 'seconds': 0.0, 'bytes': 0}
+    return _stages[name]
+
+
+def add_time(name, seconds):
+    with _lock:
+        stage = _stage(name)
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+
+
+def add_bytes(name, count):
+    with _lock:
+        _stage(name)['bytes'] += count
+
+
+def timed(name):
+    """
+    Decorator adding the time spent in the function to the given stage
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add_time(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+class stage(object):
+    """
+    Context manager adding the time spent in the block to the given stage
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.time() - self.start)
+
+
+def register_endpoints(endpoints):
+    """
+    Name the requests by url prefix, {prefix: name}. Other requests are
+    counted by host.
+    """
+    global _endpoints
+    with _lock:
+        _endpoints = sorted(endpoints.items(), key=lambda e: -len(e[0]))
+
+
+def count_request(response, *args, **kwargs):
+    """
+    Response hook of the session, counts the requests per endpoint
+    """
+    url = response.request.url if response.request is not None else response.url
+    endpoint = None
+    for prefix, name in _endpoints:
+        if url.startswith(prefix):
+            endpoint = name
+            break
+    if endpoint is None:
+        endpoint = urlparse(url).netloc
+    with _lock:
+        _requests[endpoint] = _requests.get(endpoint, 0) + 1
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _requests.clear()
+
+
+def drain():
+    """
+    Return the measures of this process and start over, used by workers to
+    send them to the parent
+    """
+    with _lock:
+        measures = {'stages': {k: dict(v) for k, v in _stages.items()},
+                    'requests': dict(_requests)}
+        _stages.clear()
+        _requests.clear()
+    return measures
+
+
+def merge(measures):
+    """
+    Add the measures drained from a worker
+    """
+    if not measures:
+        return
+    with _lock:
+        for name, values in measures['stages'].items():
+            stage = _stage(name)
+            for key, value in values.items():
+                stage[key] += value
+        for endpoint, count in measures['requests'].items():
+            _requests[endpoint] = _requests.get(endpoint, 0) + count
+
+
+def report(wall_seconds):
+    """
+    Return the measures of the run as a dict
+    """
+    with _lock:
+        stages = {}
+        for name, values in _stages.items():
+            stage = dict(values)
+            if stage['bytes'] and stage['seconds']:
+                stage['bytes_per_second'] = stage['bytes'] / stage['seconds']
+            stages[name] = stage
+        return {'wall_seconds': wall_seconds,
+                'stages': stages,
+                'requests': dict(_requests)}
+
+
+def log_summary(wall_seconds):
+    summary = report(wall_seconds)
+    logging.info('Run took %.1fs', wall_seconds)
+    for name, stage in sorted(summary['stages'].items()):
+        line = '  %-12s %6d calls %9.1fs' % (name, stage['calls'], stage['seconds'])
+        if stage['bytes']:
+            line += ' %10.1f MB' % (stage['bytes'] / 1048576.0)
+        logging.info(line)
+
+
+def _write_atomically(filename, text):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write(text)
+    os.replace(tmp_filename, filename)
+
+
+def write_json(filename, wall_seconds):
+    _write_atomically(filename, json.dumps(report(wall_seconds), indent=2, sort_keys=True) + '\n')
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(filename, wall_seconds):
+    """
+    Write the measures in the Prometheus text format, e.g. for the textfile
+    collector of node_exporter
+    """
+    summary = report(wall_seconds)
+    lines = ['# HELP edxdlr_run_seconds Wall time of the last run.',
+             '# TYPE edxdlr_run_seconds gauge',
+             'edxdlr_run_seconds %f' % wall_seconds]
+    for metric, key, help_text in (
+            ('edxdlr_stage_calls_total', 'calls', 'Calls of each stage.'),
+            ('edxdlr_stage_seconds_total', 'seconds', 'Seconds spent in each stage, summed over workers.'),
+            ('edxdlr_stage_bytes_total', 'bytes', 'Bytes transferred by each stage.')):
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s counter' % metric)
+        for name, stage in sorted(summary['stages'].items()):
+            lines.append('%s{stage="%s"} %s' % (metric, _label(name), stage[key]))
+    lines.append('# HELP edxdlr_http_requests_total HTTP requests per endpoint.')
+    lines.append('# TYPE edxdlr_http_requests_total counter')
+    for endpoint, count in sorted(summary['requests'].items()):
+        lines.append('edxdlr_http_requests_total{endpoint="%s"} %d' % (_label(endpoint), count))
+    _write_atomically(filename, '\n'.join(lines) + '\n')
@@ -4,12 +4,12 @@
 Parsing and extraction functions
 """
 import enum
+import hashlib
 import re
 import json
 import sys
 import logging
 
-from datetime import timedelta, datetime
 
 if sys.version_info[0] >= 3:
     import html
@@ -22,36 +22,118 @@ from bs4 import BeautifulSoup as BeautifulSoup_
 from common import Course, Block, Video, WebPage, Material
 
 
+# fields of a sequence item that change with the learner's progress, not
+# with the content, and are left out of fingerprints
+VOLATILE_ITEM_KEYS = ('complete', 'bookmarked')
+
+
+def item_fingerprint(item):
+    """
+    Digest of a sequence item, stable as long as its content does not change
+    """
+    stable = {k: v for k, v in item.items() if k not in VOLATILE_ITEM_KEYS}
+    text = json.dumps(stable, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# start of a video block, then the markers that end it, in order
+RE_VIDEO_START = re.compile(r'id="video_[0-9a-f]*"')
+VIDEO_MARKERS = ('class="video closed"', '>', '</div>')
+RE_METADATA = re.compile(r"data-metadata='(.*?)'")
+
+# start of a link to a course asset, then the markers that end it, in order
+RE_FILE_START = re.compile(r'<a href="/assets')
+FILE_MARKERS = ('" target="[object Object]">', '</a>')
+RE_LINK = re.compile(r'href="(.*?)"')
+
+
+def _iter_blocks(page, re_start, markers):
+    """
+    Yield the non-overlapping blocks of page that start with re_start and
+    contain markers, in this order, each marker being the first one after
+    the previous; the same blocks as the lazy pattern start.*?m1.*?m2...
+    """
+    position = 0
+    while True:
+        start = re_start.search(page, position)
+        if start is None:
+            return
+        end = start.end()
+        for marker in markers:
+            end = page.find(marker, end)
+            if end < 0:
+                # no later start can be completed either
+                return
+            end += len(marker)
+        yield page[start.start():end]
+        position = end
+
 # Force use of bs4 with html.parser
 BeautifulSoup = lambda page: BeautifulSoup_(page, 'html.parser')
 
 
-def edx_json2srt(o):
+SUBTITLE_FORMATS = ('srt', 'vtt')
+
+
+def _milliseconds(value):
     """
-    Transform the dict 'o' into the srt subtitles format
+    Integer milliseconds of a cue time, rounded to the microsecond and
+    truncated like the former datetime based conversion
+    """
+    return int(round(value * 1000)) // 1000
+
+
+# zero padded numbers, looked up instead of formatted for every cue
+_TWO_DIGITS = ['%02d' % n for n in range(100)]
+_THREE_DIGITS = ['%03d' % n for n in range(1000)]
+
+
+def _timestamp(ms, separator):
+    seconds, ms = divmod(ms, 1000)
+    hours = seconds // 3600
+    return ((_TWO_DIGITS[hours] if hours < 100 else str(hours)) + ':'
+            + _TWO_DIGITS[seconds // 60 % 60] + ':' + _TWO_DIGITS[seconds % 60]
+            + separator + _THREE_DIGITS[ms])
+
+
+def iter_subtitle_cues(o, subtitle_format='srt'):
+    """
+    Yields the dict 'o' (edX transcript json) as text in the srt or vtt
+    format, one cue at a time
     """
     if o == {}:
-        return ''
+        return
 
-    base_time = datetime(1, 1, 1)
-    output = []
+    separator = ','
+    if subtitle_format == 'vtt':
+        separator = '.'
+        yield 'WEBVTT\n\n'
 
     for i, (s, e, t) in enumerate(zip(o['start'], o['end'], o['text'])):
         if t == '':
             continue
+        if subtitle_format == 'vtt':
+            # the arrow would end the cue text
+            t = t.replace('-->', '->')
+        if type(s) is not int:
+            s = _milliseconds(s)
+        if type(e) is not int:
+            e = _milliseconds(e)
+        yield '%d\n%s --> %s\n%s\n\n' % (i, _timestamp(s, separator),
+                                          _timestamp(e, separator), t)
+
+
+def write_subtitles(o, output, subtitle_format='srt'):
+    """
+    Write the dict 'o' to the text file output in the srt or vtt format
+    """
+    output.writelines(iter_subtitle_cues(o, subtitle_format))
 
-        output.append(str(i) + '\n')
-
-        s = base_time + timedelta(seconds=s/1000.)
-        e = base_time + timedelta(seconds=e/1000.)
-        time_range = "%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d\n" % \
-                     (s.hour, s.minute, s.second, s.microsecond/1000,
-                      e.hour, e.minute, e.second, e.microsecond/1000)
-
-        output.append(time_range)
-        output.append(t + "\n\n")
 
-    return ''.join(output)
+def edx_json2srt(o):
+    """
+    Transform the dict 'o' into the srt subtitles format
+    """
+    return ''.join(iter_subtitle_cues(o, 'srt'))
 
 #CHANGE: merged everything to one single EdxExtractor
 
@@ -168,6 +250,7 @@ class EdxExtractor(object):
             vblock['id'] = x['id']
             vblock['lms_web_url'] = url + '/' + x['id'] + '?show_title=0&show_bookmark_button=0&recheck_access=1&view=student_view'
             vblock['children'] = []
+            vblock['fingerprint'] = item_fingerprint(x)
         
             all_blocks.update({x['id']: Block(position = len(all_blocks)+1, content = vblock)})
             all_blocks[parent_id].childrenid.append(x['id']);
@@ -176,25 +259,19 @@ class EdxExtractor(object):
     
     def sort_blocks(self, all_blocks):
         """
-        Extract and attach vertical blocks
+        Attach the children of every block and return the indexed root
         """
-        all_block_names = list(all_blocks.keys())
-        
-        # generate children
-        for i in all_blocks:
-            all_blocks[i].children = [all_blocks[x] for x in all_blocks[i].childrenid]
-
-        # generate tree
-        root_id = all_block_names[0]
-        for i, block_name in enumerate(all_block_names, 1):
-            if block_name.find('type@course'):
-                root_id = block_name
-                break
-        for i in all_blocks:
-            all_blocks[i].children = [all_blocks[x] for x in all_blocks[i].childrenid]
+        for block in all_blocks.values():
+            block.children = [all_blocks[x] for x in block.childrenid]
+
+        # the root is the course block (the first block if there is none)
+        root = next((block for block in all_blocks.values() if block.type == 'course'),
+                    None)
+        if root is None:
+            root = next(iter(all_blocks.values()))
+        root.index()
+        return root
 
-        return all_blocks[root_id]
-        
     def extract_units_from_html(self, url, page, file_formats):
         """
         Extract Units from a vertical
@@ -202,29 +279,25 @@ class EdxExtractor(object):
         # in this function we avoid using beautifulsoup for performance reasons
         # parsing html with regular expressions is really nasty, don't do this if
         # you don't need to !
+        #
+        # the blocks are located with str.find from the end of the previous
+        # one, which matches what lazy DOTALL patterns would find but never
+        # backtracks, so a page is scanned in linear time
         
         # page itself is a unit!
         units = [WebPage(url, page)]
-        
-        h = html
 
-        video_units = re.compile('(id="video_[0-9a-f]*".*?class="video closed".*?>.*?<\/div>)',re.DOTALL)
-        for video_html in video_units.findall(page):
-        
-            re_metadata = re.compile(r"data-metadata='(.*?)'")
-            match_metadatas = re_metadata.findall(video_html.replace('&#34;','"'))
-            for match_metadata in match_metadatas:
-                metadata = h.unescape(match_metadata)
-                metadata = json.loads(h.unescape(metadata))
-                units.append(Video(metadata))
-        
-        file_units = re.compile('(<a href=\"\/assets.*?\" target=\"\[object Object\]\">.*?<\/a>)',re.DOTALL)
-        for file_html in file_units.findall(page):
-        
-            re_link = re.compile(r"href=\"(.*?)\"")
-            match_links = re_link.findall(file_html)
-            
-            for material_link in match_links:
+        for video_html in _iter_blocks(page, RE_VIDEO_START, VIDEO_MARKERS):
+            video_html = video_html.replace('&#34;','"')
+            for match_metadata in RE_METADATA.findall(video_html):
+                metadata = html.unescape(match_metadata)
+                if '&' in metadata:
+                    # metadata may be escaped twice
+                    metadata = html.unescape(metadata)
+                units.append(Video(json.loads(metadata)))
+
+        for file_html in _iter_blocks(page, RE_FILE_START, FILE_MARKERS):
+            for material_link in RE_LINK.findall(file_html):
                 units.append(Material(material_link))
                 
         return units
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+The retry policy of every HTTP request of a run
+
+Failed attempts are retried after an exponential backoff with full jitter,
+or after the delay of a Retry-After header. Only transient failures are
+retried: network errors, timeouts, truncated bodies and the statuses listed
+in RETRYABLE_STATUS. Other 4xx are hard failures and raise at once.
+
+Retries are drawn from a budget shared by every worker of the run, which
+successful requests refill. During an outage the budget runs dry and the
+requests fail fast instead of multiplying the load on the server. A pool
+gets the policy through its initializer, see edxdlr.pool_init.
+"""
+
+import logging
+import multiprocessing
+import random
+
+import requests
+import urllib3
+
+import throttle
+
+DEFAULT_RETRIES = 3
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30.0
+# retries allowed per successful request, on top of the reserve
+DEFAULT_BUDGET_RATIO = 0.2
+DEFAULT_BUDGET_RESERVE = 10
+DEFAULT_BUDGET_CAP = 100
+# longest Retry-After honoured, a longer one fails the request
+MAX_RETRY_AFTER = 300.0
+
+# request timeout, neither dead connections nor stalled reads hang a worker
+TIMEOUT = (30, 60)
+
+RETRYABLE_STATUS = frozenset([408, 425, 429, 500, 502, 503, 504])
+# statuses telling that the request was not processed at all
+REFUSED_STATUS = frozenset([429, 503])
+
+
+class TransientError(IOError):
+    """
+    A failure worth retrying, e.g. a truncated download
+    """
+
+
+def _status(error):
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
+
+
+def retry_after(error):
+    """
+    Seconds asked by the Retry-After header of the failed response, or None
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    return throttle.parse_retry_after(response.headers.get('Retry-After'))
+
+
+def is_retryable(error, idempotent=True):
+    """
+    Whether the request that failed with error may be sent again. A request
+    that is not idempotent is only sent again if it surely had no effect.
+    """
+    status = _status(error)
+    if not idempotent:
+        return (isinstance(error, requests.ConnectTimeout)
+                or status in REFUSED_STATUS)
+    if isinstance(error, requests.HTTPError):
+        return status in RETRYABLE_STATUS
+    return isinstance(error, (TransientError,
+                              requests.ConnectionError,
+                              requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError,
+                              urllib3.exceptions.HTTPError))
+
+
+def check(response):
+    """
+    Raise the responses that should be retried, return the others
+    """
+    if response.status_code in RETRYABLE_STATUS:
+        response.raise_for_status()
+    return response
+
+
+class RetryBudget(object):
+    """
+    Retries left to the run, shared across processes. It starts with
+    `reserve` retries, every success adds `ratio` retries up to `cap`.
+    """
+    def __init__(self, ratio=DEFAULT_BUDGET_RATIO, reserve=DEFAULT_BUDGET_RESERVE,
+                 cap=DEFAULT_BUDGET_CAP):
+        self.ratio = ratio
+        self.cap = max(cap, reserve)
+        self.balance = multiprocessing.RawValue('d', reserve)
+        self.lock = multiprocessing.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.balance.value = min(self.cap, self.balance.value + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.balance.value < 1:
+                return False
+            self.balance.value -= 1
+            return True
+
+
+class RetryPolicy(object):
+    def __init__(self, retries=DEFAULT_RETRIES, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, budget=None):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def delay(self, attempt, error=None):
+        """
+        Seconds to wait before the retry following attempt (from 0)
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        asked = retry_after(error) if error is not None else None
+        return max(backoff, asked or 0)
+
+    def call(self, function, description, idempotent=True, retries=None):
+        """
+        Call function until it succeeds, retrying the transient failures.
+        The last error is raised once the retries or the budget are spent.
+        """
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            try:
+                result = function()
+            except Exception as e:
+                if not is_retryable(e, idempotent) or attempt >= retries:
+                    raise
+                wait = self.delay(attempt, e)
+                if wait > MAX_RETRY_AFTER:
+                    logging.warning('%s: server asks to wait %ds, giving up', description, wait)
+                    raise
+                if self.budget is not None and not self.budget.withdraw():
+                    logging.warning('%s: retry budget spent, giving up', description)
+                    raise
+                attempt += 1
+                logging.warning('%s: %s, retrying in %.1fs [%d/%d]',
+                                description, e, wait, attempt, retries)
+                throttle.sleep(wait)
+            else:
+                if self.budget is not None:
+                    self.budget.deposit()
+                return result
+
+
+# the policy of this process
+policy = RetryPolicy()
+
+
+def configure(new_policy):
+    """
+    Set the retry policy of this process
+    """
+    global policy
+    policy = new_policy
+
+
+def call(function, description, idempotent=True, retries=None):
+    """
+    policy.call(), see RetryPolicy.call
+    """
+    return policy.call(function, description, idempotent, retries)
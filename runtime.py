@@ -3,13 +3,73 @@
 
 # this module shares variables across files
 
+import os
 import requests
+import metrics
+from requests.adapters import HTTPAdapter
 
 global session
 global headers
 
-def initialize():
+# persistent cache of extracted resources, see cache.py
+cache = None
+
+# keep-alive connections kept per host
+DEFAULT_POOL_SIZE = 16
+
+_pool_size = DEFAULT_POOL_SIZE
+# process owning the session, a forked worker must not reuse its sockets
+_pid = None
+
+def _new_session(pool_size):
+    """
+    Build a session whose adapters keep pool_size connections per host.
+    The adapters do not retry, retry.py does.
+    """
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=0)
+    new_session = requests.session()
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    new_session.hooks['response'].append(metrics.count_request)
+    return new_session
+
+def _start_session(pool_size, cookies):
     global session
+    global _pool_size, _pid
+    _pool_size = pool_size
+    _pid = os.getpid()
+    session = _new_session(pool_size)
+    if cookies:
+        session.cookies.update(cookies)
+
+def initialize(pool_size=DEFAULT_POOL_SIZE):
     global headers
-    session = requests.session()
+    _start_session(pool_size, None)
     headers = []
+
+def get_session():
+    """
+    Return the session of the current process. Every module downloads through
+    it, so connections are reused across requests and threads.
+    A worker process gets its own session, with the cookies of its parent.
+    """
+    global session
+    if _pid != os.getpid():
+        cookies = session.cookies if _pid is not None else None
+        _start_session(_pool_size, cookies)
+    return session
+
+def transport_config():
+    """
+    Settings needed to rebuild the session in a (spawned) worker process
+    """
+    cookies = session.cookies.copy() if _pid is not None else None
+    return {'pool_size': _pool_size, 'cookies': cookies}
+
+def configure(config):
+    """
+    Rebuild the session from transport_config(), in a worker process
+    """
+    _start_session(config['pool_size'], config['cookies'])
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Order in which the units of a course are downloaded (--order)
+
+    course       the order of the course tree, to watch while downloading
+    small-first  documents before the long videos
+    large-first  the longest transfers first, so no worker is left with a
+                 large video at the end of the run
+
+Several courses are downloaded together: their units are interleaved by
+round_robin(), so every course being downloaded gets its share of the
+workers and a small course fills the gaps left by a large one.
+
+The units are reordered within a window of the next units extracted, which
+keeps the extraction ahead of the downloads bounded. Units of the same
+estimated size keep their course order.
+"""
+
+import collections
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+ORDERS = ('course', 'small-first', 'large-first')
+DEFAULT_WINDOW = 256
+# courses extracted and downloaded at the same time
+DEFAULT_ACTIVE_COURSES = 4
+
+
+def _estimated(items, estimate, workers):
+    """
+    Yields (estimate(item), item) in the order of items, with the estimates
+    computed by `workers` threads a few items ahead
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append((executor.submit(estimate, item), item))
+            if len(pending) >= 2 * workers:
+                future, ready = pending.popleft()
+                yield future.result(), ready
+        while pending:
+            future, ready = pending.popleft()
+            yield future.result(), ready
+
+
+def prioritize(items, order, estimate, window=DEFAULT_WINDOW, workers=4):
+    """
+    Yields items in the given order, estimate(item) being the size of item.
+    """
+    if order == 'course':
+        yield from items
+        return
+
+    sign = 1 if order == 'small-first' else -1
+    heap = []
+    sequence = itertools.count()
+    for size, item in _estimated(items, estimate, max(1, workers)):
+        heapq.heappush(heap, (sign * size, next(sequence), item))
+        if len(heap) >= max(1, window):
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def round_robin(iterables, active=DEFAULT_ACTIVE_COURSES):
+    """
+    Yields one item of each iterable in turn until they are all exhausted.
+    At most `active` of them are being consumed at a time, the next one
+    starts when one is exhausted.
+    """
+    waiting = (iter(iterable) for iterable in iterables)
+    iterators = collections.deque(itertools.islice(waiting, max(1, active)))
+    while iterators:
+        iterator = iterators.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            iterators.extend(itertools.islice(waiting, 1))
+            continue
+        iterators.append(iterator)
+        yield item
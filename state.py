@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Download state of an output directory
+
+Every resource planned for download is recorded in a sqlite database in the
+output directory, with its url, target path, size, status and ETag. The
+decisions to skip or resume a download are taken from this index, instead of
+probing the filesystem for every file.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from common import DEFAULT_STATE_FILENAME
+from utils import mkdir_p
+
+PLANNED = 'planned'
+DONE = 'done'
+FAILED = 'failed'
+
+# one database per output directory and process, see get_state()
+_states = {}
+_states_lock = threading.Lock()
+
+
+class DownloadState(object):
+    """
+    Index of the resources of an output directory
+    """
+    def __init__(self, directory):
+        mkdir_p(directory)
+        self.filename = os.path.join(directory, DEFAULT_STATE_FILENAME)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.filename, timeout=30,
+                                  check_same_thread=False)
+        # several worker processes write to the database
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS resources ('
+                        'path TEXT PRIMARY KEY, '
+                        'dir TEXT NOT NULL, '
+                        'name TEXT NOT NULL, '
+                        'url TEXT, '
+                        'size INTEGER, '
+                        'etag TEXT, '
+                        'status TEXT NOT NULL, '
+                        'updated REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS resources_dir_name '
+                        'ON resources (dir, name)')
+        # fingerprints of the verticals of the last sync of each course
+        self.db.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                        'course_id TEXT NOT NULL, '
+                        'block_id TEXT NOT NULL, '
+                        'fingerprint TEXT NOT NULL, '
+                        'PRIMARY KEY (course_id, block_id))')
+        self.db.commit()
+
+    def get(self, filename):
+        """
+        Return the row of filename as a dict, or None if it is unknown.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT url, size, etag, status FROM resources '
+                                  'WHERE path=?', (filename,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('url', 'size', 'etag', 'status'), row))
+
+    def is_done(self, filename, url=None):
+        """
+        Whether filename was completely downloaded, from url if given.
+        Files downloaded before the database existed are found on disk and
+        recorded on the way, and done files deleted since are reset.
+        """
+        row = self.get(filename)
+        if row is not None:
+            if row['status'] != DONE:
+                return False
+            if url is not None and row['url'] is not None and row['url'] != url:
+                # the name now belongs to another url, e.g. a unit that
+                # moved within its vertical
+                return False
+            if os.path.exists(filename):
+                return True
+            self.set_status(filename, None, PLANNED)
+            return False
+        if os.path.exists(filename):
+            self.set_status(filename, None, DONE, os.path.getsize(filename))
+            return True
+        return False
+
+    def set_status(self, filename, url, status, size=None):
+        directory, name = os.path.split(filename)
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO resources '
+                            '(path, dir, name, status, updated) VALUES (?, ?, ?, ?, ?)',
+                            (filename, directory, name, status, time.time()))
+            self.db.execute('UPDATE resources SET url=COALESCE(?, url), '
+                            'size=COALESCE(?, size), status=?, updated=? WHERE path=?',
+                            (url, size, status, time.time(), filename))
+            self.db.commit()
+
+    def plan(self, url, filename):
+        self.set_status(filename, url, PLANNED)
+
+    def done(self, filename):
+        self.set_status(filename, None, DONE, os.path.getsize(filename))
+
+    def fail(self, filename):
+        self.set_status(filename, None, FAILED)
+
+    def set_etag(self, filename, etag):
+        with self.lock:
+            self.db.execute('UPDATE resources SET etag=? WHERE path=?',
+                            (etag, filename))
+            self.db.commit()
+
+    def get_snapshot(self, course_id):
+        """
+        Return {block_id: fingerprint} saved by the last sync of the course.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT block_id, fingerprint FROM snapshots '
+                                   'WHERE course_id=?', (course_id,)).fetchall()
+        return dict(rows)
+
+    def save_snapshot(self, course_id, fingerprints):
+        """
+        Replace the snapshot of the course by {block_id: fingerprint}.
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM snapshots WHERE course_id=?', (course_id,))
+            self.db.executemany('INSERT INTO snapshots VALUES (?, ?, ?)',
+                                [(course_id, block_id, fingerprint)
+                                 for block_id, fingerprint in fingerprints.items()])
+            self.db.commit()
+
+
+def get_state(directory):
+    """
+    Return the state of the output directory, opened once per process.
+    """
+    key = (os.getpid(), directory)
+    with _states_lock:
+        if key not in _states:
+            _states[key] = DownloadState(directory)
+        return _states[key]
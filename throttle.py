@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bandwidth limits shared by every worker of a run (--limit-rate)
+
+The token buckets live in shared memory, so the threads of a process and the
+processes of a pool all draw from the same budget. A pool gets the limiter
+through its initializer, see edxdlr.pool_init.
+
+Every transfer goes through consume(), which is also where the transfers of
+a process are stopped on Ctrl-C, see stop().
+"""
+
+import multiprocessing
+import re
+import threading
+import time
+
+from six.moves.urllib.parse import urlparse
+
+# bytes read at a time by the throttled copies
+CHUNK_SIZE = 64 * 1024
+
+RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# the limiter of this process, None when unlimited
+limiter = None
+
+# set by stop(), the transfers of this process then raise Stopped
+stopping = threading.Event()
+
+
+class Stopped(Exception):
+    """
+    The transfers of this process are being stopped
+    """
+
+
+def stop():
+    """
+    Make the transfers of this process raise Stopped at their next chunk,
+    and cut short the waits for bandwidth, a slot or a retry
+    """
+    stopping.set()
+
+
+def sleep(seconds):
+    """
+    time.sleep, interrupted by stop()
+    """
+    if stopping.wait(seconds):
+        raise Stopped()
+
+
+def parse_rate(text):
+    """
+    Parse a rate like 500K, 2M or 1.5m (bytes per second)
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:b|b/s)?\s*$', text.lower())
+    if match is None:
+        raise ValueError('invalid rate: %s' % text)
+    return float(match.group(1)) * RATE_UNITS[match.group(2)]
+
+
+def parse_host_rate(text):
+    """
+    Parse HOST=RATE into (host, bytes per second)
+    """
+    host, _, rate = text.partition('=')
+    if not host.strip():
+        raise ValueError('invalid host rate: %s' % text)
+    return host.strip(), parse_rate(rate)
+
+
+class TokenBucket(object):
+    """
+    Token bucket of `rate` bytes per second, shared across processes.
+    A consumer may overdraw the bucket, it then sleeps until the debt is paid,
+    which keeps the average rate without splitting reads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, CHUNK_SIZE))
+        self.tokens = multiprocessing.RawValue('d', self.burst)
+        self.stamp = multiprocessing.RawValue('d', time.time())
+        self.lock = multiprocessing.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens.value + (now - self.stamp.value) * self.rate)
+            tokens -= amount
+            self.tokens.value = tokens
+            self.stamp.value = now
+        if tokens < 0:
+            sleep(-tokens / self.rate)
+
+
+class Limiter(object):
+    """
+    A global bucket and optional buckets per host
+    """
+    def __init__(self, rate=None, host_rates=None):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.host_buckets = {host: TokenBucket(host_rate)
+                             for host, host_rate in (host_rates or {}).items()}
+
+    def consume(self, url, amount):
+        if self.host_buckets:
+            bucket = self.host_buckets.get(urlparse(url).hostname)
+            if bucket is not None:
+                bucket.consume(amount)
+        if self.bucket is not None:
+            self.bucket.consume(amount)
+
+
+def configure(new_limiter):
+    """
+    Set the limiter of this process
+    """
+    global limiter
+    limiter = new_limiter
+
+
+def consume(url, amount):
+    """
+    Account for amount bytes received from url, sleeping if over budget
+    """
+    if stopping.is_set():
+        raise Stopped()
+    if limiter is not None:
+        limiter.consume(url, amount)
+
+
+def copy(url, src, dst):
+    """
+    shutil.copyfileobj, within the bandwidth budget
+    """
+    while True:
+        data = src.read(CHUNK_SIZE)
+        if not data:
+            return
+        consume(url, len(data))
+        dst.write(data)
+
+
+# ##### adaptive concurrency (--adaptive)
+
+# limits of this process by kind ('transfer', 'page'), empty when disabled
+adaptive = {}
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header (delay or http date), or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_congestion(status):
+    """
+    Whether a response status (None for a network error) asks to slow down
+    """
+    return status is None or status == 429 or status >= 500
+
+
+class AdaptiveLimit(object):
+    """
+    AIMD limit on the number of requests active at the same time, shared
+    across processes.
+
+    Each response within the latency target raises the limit by 1/limit,
+    about one more slot per round of requests. A 429, a 5xx, a network
+    error or a slow response halves it, at most once per `cooldown` seconds
+    so that one congestion event is not counted many times. A Retry-After
+    header holds every new request until it expires.
+    """
+    def __init__(self, maximum, initial=None, latency_target=None, cooldown=1.0):
+        self.maximum = max(1, maximum)
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.limit = multiprocessing.RawValue('d', min(self.maximum, initial or self.maximum))
+        self.active = multiprocessing.RawValue('i', 0)
+        self.pause_until = multiprocessing.RawValue('d', 0.0)
+        self.last_decrease = multiprocessing.RawValue('d', 0.0)
+        self.condition = multiprocessing.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                if stopping.is_set():
+                    raise Stopped()
+                wait = self.pause_until.value - time.time()
+                if wait <= 0 and self.active.value < int(self.limit.value):
+                    self.active.value += 1
+                    return
+                self.condition.wait(wait if wait > 0 else 1.0)
+
+    def release(self, status=None, latency=None, retry_after=None):
+        with self.condition:
+            now = time.time()
+            self.active.value -= 1
+            slow = (self.latency_target is not None and latency is not None
+                    and latency > self.latency_target)
+            if is_congestion(status) or slow:
+                if now - self.last_decrease.value > self.cooldown:
+                    self.limit.value = max(1.0, self.limit.value / 2)
+                    self.last_decrease.value = now
+            else:
+                self.limit.value = min(self.maximum, self.limit.value + 1.0 / self.limit.value)
+            if retry_after:
+                self.pause_until.value = max(self.pause_until.value, now + retry_after)
+            self.condition.notify_all()
+
+
+def configure_adaptive(limits):
+    """
+    Set the adaptive limits of this process, {kind: AdaptiveLimit}
+    """
+    global adaptive
+    adaptive = limits or {}
+
+
+class slot(object):
+    """
+    Context manager holding one slot of the adaptive limit of `kind` while a
+    request is active. observe() the response so that the limit adapts to
+    it; leaving without a response counts as a network error.
+
+        with throttle.slot('transfer') as s:
+            r = session.get(url)
+            s.observe(r)
+    """
+    def __init__(self, kind):
+        self.limit = adaptive.get(kind)
+        self.status = None
+        self.latency = None
+        self.retry_after = None
+
+    def __enter__(self):
+        if self.limit is not None:
+            self.limit.acquire()
+        return self
+
+    def observe(self, response):
+        self.status = response.status_code
+        self.latency = response.elapsed.total_seconds()
+        self.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+    def __exit__(self, *exc_info):
+        if self.limit is not None:
+            self.limit.release(self.status, self.latency, self.retry_after)
@@ -16,7 +16,9 @@ import logging
 import os
 import string
 import subprocess
+import retry
 import runtime
+import throttle
 
 def get_filename_from_prefix(target_dir, filename_prefix):
     """
@@ -56,24 +58,35 @@ def directory_name(initial_name):
 
 
 def post_page_contents(url, headers, postdata):
-    response = runtime.session.post(url, data=postdata, headers=headers)
-    if response.status_code == 200:
+    """
+    Post postdata to url and return the contents of the response. The post
+    is only sent again if the server surely did not process it.
+    """
+    def post():
+        with throttle.slot('page') as page:
+            response = runtime.get_session().post(url, data=postdata, headers=headers,
+                                                  timeout=retry.TIMEOUT)
+            page.observe(response)
+        response.raise_for_status()
         return response.content.decode('utf-8')
-    else:
-        return ''
+    return retry.call(post, url, idempotent=False)
 
 def get_page_contents(url, headers, params=None):
     """
     Get the contents of the page at the URL given by url. While making the
     request, we use the headers given in the dictionary in headers.
+    Transient failures are retried, an error status raises HTTPError.
     """
     if not params is None:
         url = url+'?'+params
-    response = runtime.session.get(url, params=params, headers=headers)
-    if response.status_code == 200:
+    def get():
+        with throttle.slot('page') as page:
+            response = runtime.get_session().get(url, params=params, headers=headers,
+                                                 timeout=retry.TIMEOUT)
+            page.observe(response)
+        response.raise_for_status()
         return response.content.decode('utf-8')
-    else:
-        return ''
+    return retry.call(get, url)
 
 
 def post_page_contents_as_json(url, headers, postdata):